@@ -0,0 +1,151 @@
+# Copyright (c) 2024 ASPEED Technology Inc.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# In-process image builds from buffers: nothing is read from or written to
+# disk, callers pass the FMC binary, the prebuilts and loaded keys, and get
+# the image back or streamed to a writer.
+#
+#   from api import build_image
+#   from prebuilt import PrebuiltType
+#
+#   img = build_image(fmc, 2, { PrebuiltType.DP_FW : dp_fw }, svn=3,
+#                     ecc_key=ecc_key, lms_key=lms_key)
+
+import hashlib
+from image_io import CHUNK_SIZE
+from main import FmcInfo
+from main import PrebuiltInfo
+from main import gen_fmc_hdr_v1
+from main import gen_fmc_hdr_v2
+from metrics import span
+
+def _input_info(info, data, label):
+    # hash a bytes-like object, or a binary file object from its current
+    # position to EOF; seekable files are read again when the image is
+    # written, others are loaded once
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        info.data = memoryview(data).cast("B")
+        info.file = None
+        info.size = len(info.data)
+        info.dgst = hashlib.sha384(info.data)
+        return info
+
+    if not hasattr(data, "read"):
+        raise RuntimeError("invalid {} input {}, expected bytes, memoryview or a binary file".format(label, type(data).__name__))
+
+    if not (hasattr(data, "seekable") and data.seekable()):
+        return _input_info(info, data.read(), label)
+
+    info.data = None
+    info.file = data
+    info.pos = data.tell()
+    info.size = 0
+    info.dgst = hashlib.sha384()
+
+    while True:
+        buf = data.read(CHUNK_SIZE)
+        if not buf:
+            break
+        info.dgst.update(buf)
+        info.size += len(buf)
+
+    return info
+
+def _write_input(write, info, size):
+    if info.file is None:
+        write(info.data)
+        return
+
+    info.file.seek(info.pos)
+
+    left = size
+    while left > 0:
+        buf = info.file.read(min(left, CHUNK_SIZE))
+        if not buf:
+            raise RuntimeError("input file shrank while building the image")
+        write(buf)
+        left -= len(buf)
+
+def fmc_buffer_info(fmc, fmc_svn=0) -> FmcInfo:
+    with span("fmc_info"):
+        fmc_info = _input_info(FmcInfo(), fmc, "FMC")
+
+    # force alignment due to the broken design
+    fmc_info.svn = fmc_svn
+    fmc_info.pad = (4 - (fmc_info.size & 3)) & 3
+    fmc_info.dgst.update(bytes(fmc_info.pad))
+    fmc_info.dgst = fmc_info.dgst.digest()
+    fmc_info.size += fmc_info.pad
+
+    return fmc_info
+
+def prebuilt_buffer_info(prebuilts) -> list:
+    # prebuilts maps each prebuilt type to its binary, the header lists them
+    # in the mapping order
+    pbs_info = []
+
+    for pb_type, pb in prebuilts.items():
+        with span("prebuilt_info"):
+            pbi = _input_info(PrebuiltInfo(), pb, "prebuilt type={}".format(int(pb_type)))
+
+        pbi.name = getattr(pb_type, "name", str(pb_type))
+        pbi.type = int(pb_type)
+        pbi.dgst = pbi.dgst.digest()
+        pbs_info.append(pbi)
+
+    return pbs_info
+
+def build_image(fmc, version: int, prebuilts, svn: int = 0,
+                ecc_key=None, ecc_key_index: int = 0,
+                lms_key=None, lms_key_index: int = 0,
+                deterministic_ecdsa: bool = False, out=None):
+    # keys are loaded private keys (or LmsSigner/LmsReservation), or paths;
+    # returns the image as a bytearray, or writes it to out and returns its size
+    fmc_info = fmc_buffer_info(fmc, svn)
+    pbs_info = prebuilt_buffer_info(prebuilts)
+
+    if version == 1:
+        hdr = gen_fmc_hdr_v1(fmc_info, pbs_info)
+    elif version == 2:
+        hdr = gen_fmc_hdr_v2(fmc_info, pbs_info,
+                             ecc_key_index, ecc_key,
+                             lms_key_index, lms_key, deterministic_ecdsa)
+    else:
+        raise RuntimeError("invalid FMC header version={}".format(version))
+
+    hdr_bytes = hdr.output()
+    size = len(hdr_bytes) + fmc_info.size + sum(pbi.size for pbi in pbs_info)
+
+    ret = None
+    if out is None:
+        ret = bytearray()
+        write = ret.extend
+    else:
+        write = out.write
+
+    # Header || FMC Binary || Prebuilt Binaries
+    with span("write", size=size):
+        write(hdr_bytes)
+        _write_input(write, fmc_info, fmc_info.size - fmc_info.pad)
+        write(bytes(fmc_info.pad))
+        for pbi in pbs_info:
+            _write_input(write, pbi, pbi.size)
+
+    return ret if ret is not None else size
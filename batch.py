@@ -0,0 +1,351 @@
+# Copyright (c) 2024 ASPEED Technology Inc.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import copy
+import json
+import threading
+import time
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+from os import path
+from main import gen_fmc_info
+from main import gen_prebuilt_info
+from main import gen_fmc_hdr_v1
+from main import gen_fmc_hdr_v2
+from main import load_ecc_key
+from main import load_lms_key
+from main import write_image
+from plan import plan_spec
+from prebuilt import PREBUILT_BIN
+
+SPEC_DEFAULTS = {
+    "svn"           : 0,
+    "ecc_key"       : None,
+    "ecc_key_index" : None,     # 0, or the key's slot in key_dir
+    "lms_key"       : None,
+    "lms_key_index" : None,
+    "key_dir"       : None,
+    "prebuilt_dir"  : "prebuilt/",
+    "deterministic_ecdsa" : False,
+}
+
+SPEC_REQUIRED = ("input", "output", "version")
+SPEC_PATHS = ("input", "output", "ecc_key", "lms_key", "key_dir", "prebuilt_dir")
+
+def make_spec(image, defaults, base_dir, label) -> dict:
+    spec = dict(defaults)
+    spec.update(image)
+
+    for key in spec:
+        if not (key in SPEC_DEFAULTS or key in SPEC_REQUIRED):
+            raise RuntimeError("unknown key '{}' in {}".format(key, label))
+
+    for key in SPEC_REQUIRED:
+        if spec.get(key) is None:
+            raise RuntimeError("missing '{}' in {}".format(key, label))
+
+    for key in SPEC_PATHS:
+        if spec[key] is not None:
+            spec[key] = path.join(base_dir, spec[key])
+
+    # gen_prebuilt_info() concatenates directory and file name
+    spec["prebuilt_dir"] = path.join(spec["prebuilt_dir"], "")
+
+    return spec
+
+def load_manifest(manifest_path):
+    # manifest is either a list of image specs, or a table of
+    # shared "defaults" plus an "images" list
+    if manifest_path.endswith(".toml"):
+        try:
+            import tomllib
+        except ImportError:
+            raise RuntimeError("TOML manifest requires python 3.11 or above")
+
+        f = open(manifest_path, "rb")
+        doc = tomllib.load(f)
+    else:
+        f = open(manifest_path, "r")
+        doc = json.load(f)
+
+    f.close()
+
+    if isinstance(doc, list):
+        doc = { "images" : doc }
+
+    defaults = dict(SPEC_DEFAULTS)
+    defaults.update(doc.get("defaults", {}))
+
+    # relative paths are resolved against the manifest location
+    base_dir = path.dirname(path.abspath(manifest_path))
+
+    specs = []
+    for i, image in enumerate(doc.get("images", [])):
+        specs.append(make_spec(image, defaults, base_dir, "manifest image #{}".format(i)))
+
+    if len(specs) == 0:
+        raise RuntimeError("no image found in manifest {}".format(manifest_path))
+
+    return specs
+
+# inputs shared by the images of one batch run, every FMC binary, prebuilt
+# directory and key is read, hashed or parsed once by whichever worker asks first;
+# long-lived users turn off share_inputs and only keep the parsed keys
+class BuildContext:
+    def __init__(self, cache=None, jobs=1, share_inputs=True):
+        self.__digest_cache = cache
+        self.__jobs = jobs
+        self.__share_inputs = share_inputs
+        self.__lock = threading.Lock()
+        self.__cache = {}
+        self.__lms_locks = {}
+        self.__lms_plan = {}
+        self.__lms_leases = {}
+
+    def __once(self, key, fn, *args):
+        with self.__lock:
+            fut = self.__cache.get(key)
+            owner = fut is None
+            if owner:
+                fut = Future()
+                self.__cache[key] = fut
+
+        if owner:
+            try:
+                fut.set_result(fn(*args))
+            except Exception as e:
+                fut.set_exception(e)
+                # a long running context retries on the next request, the
+                # key may have been fixed in the meantime
+                if not self.__share_inputs:
+                    with self.__lock:
+                        if self.__cache.get(key) is fut:
+                            del self.__cache[key]
+
+        return fut.result()
+
+    def fmc_info(self, fmc_path, fmc_svn):
+        if not self.__share_inputs:
+            return gen_fmc_info(fmc_path, fmc_svn, self.__digest_cache)
+
+        # the digest does not depend on SVN, share it across SVN variants
+        info = copy.copy(self.__once(("fmc", fmc_path), gen_fmc_info, fmc_path, 0, self.__digest_cache))
+        info.svn = fmc_svn
+
+        return info
+
+    def prebuilt_info(self, pb_dir):
+        if not self.__share_inputs:
+            return gen_prebuilt_info(pb_dir, PREBUILT_BIN, self.__digest_cache, self.__jobs)
+
+        return self.__once(("prebuilt", pb_dir), gen_prebuilt_info, pb_dir, PREBUILT_BIN,
+                           self.__digest_cache, self.__jobs)
+
+    def ecc_key(self, key_path):
+        return self.__once(("ecc", key_path), load_ecc_key, key_path)
+
+    def lms_key(self, key_path):
+        return self.__once(("lms", key_path), load_lms_key, key_path)
+
+    def key_index(self, key_dir):
+        from key_index import KeyIndex
+
+        # the key directory may change between requests, KeyIndex revalidates
+        # its own on-disk cache
+        if not self.__share_inputs:
+            return KeyIndex(key_dir)
+
+        return self.__once(("key_index", key_dir), KeyIndex, key_dir)
+
+    def lms_lock(self, key_path):
+        # LMS is stateful, signing with the same key must be serialized
+        with self.__lock:
+            return self.__lms_locks.setdefault(key_path, threading.Lock())
+
+    def plan_lms(self, counts):
+        # number of signatures expected per LMS key; planned keys sign from
+        # one leaf lease per run, in parallel and without per-signature I/O
+        self.__lms_plan = dict(counts)
+
+    def __lease(self, key_path):
+        from lms_sign import LmsSigner
+
+        key = self.lms_key(key_path)
+        if not isinstance(key, LmsSigner):
+            return None
+
+        lease = key.reserve(self.__lms_plan[key_path])
+        with self.__lock:
+            self.__lms_leases[key_path] = lease
+
+        return lease
+
+    def lms_lease(self, key_path):
+        # LmsReservation of a planned single level key, None otherwise
+        if self.__lms_plan.get(key_path, 0) <= 0:
+            return None
+
+        return self.__once(("lms_lease", key_path), self.__lease, key_path)
+
+    def release_lms(self) -> dict:
+        # key path -> (leased, used, handed back unused)
+        with self.__lock:
+            leases = self.__lms_leases
+            self.__lms_leases = {}
+
+        res = {}
+        for key_path, lease in leases.items():
+            used = lease.next - lease.start
+            res[key_path] = (lease.end - lease.start, used, lease.release())
+
+        return res
+
+def build_one(ctx, spec, verbose=False) -> dict:
+    result = { "input" : spec["input"], "output" : spec["output"] }
+    timings = {}
+    start = time.perf_counter()
+
+    try:
+        t = time.perf_counter()
+        fmc_info = ctx.fmc_info(spec["input"], spec["svn"])
+        pbs_info = ctx.prebuilt_info(spec["prebuilt_dir"])
+        timings["input"] = time.perf_counter() - t
+
+        t = time.perf_counter()
+        if spec["version"] == 1:
+            hdr = gen_fmc_hdr_v1(fmc_info, pbs_info)
+        elif spec["version"] == 2:
+            ecc_key = None
+            if spec["ecc_key"] is not None:
+                ecc_key = ctx.ecc_key(spec["ecc_key"])
+
+            lease = None
+            if spec["lms_key"] is not None:
+                lease = ctx.lms_lease(spec["lms_key"])
+
+            key_index = None
+            if spec["key_dir"] is not None:
+                key_index = ctx.key_index(spec["key_dir"])
+
+            if lease is not None:
+                hdr = gen_fmc_hdr_v2(fmc_info, pbs_info,
+                                     spec["ecc_key_index"], ecc_key,
+                                     spec["lms_key_index"], lease, spec["deterministic_ecdsa"],
+                                     key_index=key_index)
+            elif spec["lms_key"] is not None:
+                with ctx.lms_lock(spec["lms_key"]):
+                    hdr = gen_fmc_hdr_v2(fmc_info, pbs_info,
+                                         spec["ecc_key_index"], ecc_key,
+                                         spec["lms_key_index"], ctx.lms_key(spec["lms_key"]),
+                                         spec["deterministic_ecdsa"], key_index=key_index)
+            else:
+                hdr = gen_fmc_hdr_v2(fmc_info, pbs_info,
+                                     spec["ecc_key_index"], ecc_key,
+                                     spec["lms_key_index"], None, spec["deterministic_ecdsa"],
+                                     key_index=key_index)
+        else:
+            raise RuntimeError("invalid FMC header version={}".format(spec["version"]))
+        timings["header"] = time.perf_counter() - t
+
+        t = time.perf_counter()
+        write_image(spec["output"], hdr, fmc_info, pbs_info, verbose)
+        timings["write"] = time.perf_counter() - t
+
+        result["status"] = "ok"
+    except Exception as e:
+        result["status"] = "failed"
+        result["reason"] = str(e)
+
+    timings["total"] = time.perf_counter() - start
+    result["timings"] = timings
+
+    return result
+
+def run_manifest(manifest_path, jobs=1, report_path=None, verbose=False, cache=None) -> bool:
+    if jobs < 1:
+        raise RuntimeError("invalid number of jobs={}".format(jobs))
+
+    specs = load_manifest(manifest_path)
+    ctx = BuildContext(cache, jobs)
+    start = time.perf_counter()
+
+    # images over a size limit fail from os.stat() alone, before anything is
+    # hashed or an LMS leaf is leased for them
+    results = [None] * len(specs)
+    todo = []
+    for i, spec in enumerate(specs):
+        errors = plan_spec(spec)["errors"]
+        if len(errors) > 0:
+            results[i] = { "input" : spec["input"], "output" : spec["output"], "status" : "failed",
+                           "reason" : "; ".join(errors), "timings" : { "total" : 0.0 } }
+        else:
+            todo.append(i)
+
+    lms_counts = {}
+    for i in todo:
+        spec = specs[i]
+        if spec["version"] == 2 and spec["lms_key"] is not None:
+            lms_counts[spec["lms_key"]] = lms_counts.get(spec["lms_key"], 0) + 1
+    ctx.plan_lms(lms_counts)
+
+    # the verbose header dump is not thread-safe on stdout
+    try:
+        if jobs == 1 or verbose:
+            built = [build_one(ctx, specs[i], verbose) for i in todo]
+        else:
+            with ThreadPoolExecutor(max_workers=jobs) as pool:
+                built = list(pool.map(lambda i: build_one(ctx, specs[i]), todo))
+    finally:
+        # leaves of failed images go back to the key
+        leases = ctx.release_lms()
+
+    for i, r in zip(todo, built):
+        results[i] = r
+
+    report = {
+        "manifest"  : manifest_path,
+        "images"    : results,
+        "passed"    : sum(1 for r in results if r["status"] == "ok"),
+        "failed"    : sum(1 for r in results if r["status"] != "ok"),
+        "elapsed"   : time.perf_counter() - start,
+    }
+
+    for r in results:
+        if r["status"] == "ok":
+            print("OK     {} ({:.3f}s)".format(r["output"], r["timings"]["total"]))
+        else:
+            print("FAILED {}: {}".format(r["output"], r["reason"]))
+
+    print("{} built, {} failed in {:.3f}s".format(report["passed"], report["failed"], report["elapsed"]))
+
+    report["lms_leases"] = {}
+    for key_path, (leased, used, unused) in leases.items():
+        print("LMS    {}: {} leaves leased, {} used, {} returned".format(key_path, leased, used, unused))
+        report["lms_leases"][key_path] = { "leased" : leased, "used" : used, "returned" : unused }
+
+    if report_path is not None:
+        f = open(report_path, "w")
+        json.dump(report, f, indent=2)
+        f.close()
+
+    if cache is not None and len(cache.mismatches) > 0:
+        return False
+
+    return report["failed"] == 0
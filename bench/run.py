@@ -0,0 +1,312 @@
+# Copyright (c) 2024 ASPEED Technology Inc.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Benchmarks of the image generation paths on synthetic inputs.
+#
+#   python3 bench/run.py --output results.json
+#   python3 bench/run.py --save-baseline
+#   python3 bench/run.py --baseline bench/baseline.json --threshold 0.25
+#
+# Each benchmark reports the min/median/mean of --repeat runs in seconds. With
+# a baseline, a benchmark whose median is slower than baseline * (1 +
+# threshold) is a regression and the run exits with 1.
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from os import path
+
+ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import main
+import hdr_v1
+import hdr_v2
+from digest_cache import default_cache_dir
+from prebuilt import PREBUILT_BIN
+
+BENCH_BASELINE = path.join(ROOT, "bench", "baseline.json")
+BENCH_KEY_DIR = path.join(ROOT, "keys")
+BENCH_ECC_KEY = "test_oem_dss_private_key_ecdsa384_0.pem"
+BENCH_LMS_KEY = "test_oem_dss_lms_key_0"
+
+# startup of the build command, 'import main' must stay below the budget and
+# must not load the crypto stacks, which only signed builds need
+IMPORT_BUDGET_MS = 75
+IMPORT_FORBIDDEN = ("cryptography", "pyhsslms", "hdr_v1", "hdr_v2")
+
+# realistic sizes of the AST2700 prebuilts, the UEFI dominates
+BENCH_PB_SIZE = {
+    "ddr4_pmu_train_imem.bin"       : 0x10000,
+    "ddr4_pmu_train_dmem.bin"       : 0x1000,
+    "ddr4_2d_pmu_train_imem.bin"    : 0x10000,
+    "ddr4_2d_pmu_train_dmem.bin"    : 0x1000,
+    "ddr5_pmu_train_imem.bin"       : 0x10000,
+    "ddr5_pmu_train_dmem.bin"       : 0x1000,
+    "dp_fw.bin"                     : 0x8000,
+    "uefi_ast2700.bin"              : 0x800000,
+}
+
+def gen_inputs(work_dir):
+    # FMC binaries at the size limit of each header version, unaligned so
+    # the padding path is exercised
+    fmc = {}
+    for ver, hdr in ((1, hdr_v1), (2, hdr_v2)):
+        fmc[ver] = path.join(work_dir, "fmc_v{}.bin".format(ver))
+        f = open(fmc[ver], "wb")
+        f.write(os.urandom(hdr.HDR_MAX_FMCSZ - 3))
+        f.close()
+
+    pb_dir = path.join(work_dir, "prebuilt", "")
+    os.makedirs(pb_dir, exist_ok=True)
+    for name in PREBUILT_BIN:
+        f = open(pb_dir + name, "wb")
+        f.write(os.urandom(BENCH_PB_SIZE.get(name, 0x1000)))
+        f.close()
+
+    return fmc, pb_dir
+
+def prepare_lms_key(work_dir):
+    # signing consumes leaves, so sign with a copy of the test key; the
+    # Merkle tree of the copy is kept across runs in the bench state dir
+    state_dir = path.join(path.dirname(default_cache_dir()), "bench")
+    os.makedirs(state_dir, exist_ok=True)
+
+    for ext in (".prv", ".pub"):
+        shutil.copyfile(path.join(BENCH_KEY_DIR, BENCH_LMS_KEY + ext),
+                        path.join(state_dir, BENCH_LMS_KEY + ext))
+
+    tree = path.join(BENCH_KEY_DIR, BENCH_LMS_KEY + ".tree")
+    if path.isfile(tree) and not path.isfile(path.join(state_dir, BENCH_LMS_KEY + ".tree")):
+        shutil.copyfile(tree, path.join(state_dir, BENCH_LMS_KEY + ".tree"))
+
+    return path.join(state_dir, BENCH_LMS_KEY + ".prv")
+
+def import_time(module):
+    # returns (cumulative import time in seconds, imported modules) of a
+    # fresh interpreter importing module
+    res = subprocess.run([sys.executable, "-X", "importtime", "-c", "import {}".format(module)],
+                         cwd=ROOT, capture_output=True, text=True, check=True)
+
+    seconds = None
+    modules = set()
+    for line in res.stderr.splitlines():
+        # "import time: self [us] | cumulative | imported package"
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+
+        fields = line[len("import time:") :].split("|")
+        if not fields[1].strip().isdigit():
+            continue
+
+        name = fields[2].strip()
+        modules.add(name.split(".")[0])
+        if fields[2].rstrip() == " " + module:
+            seconds = int(fields[1]) / 1e6
+
+    if seconds is None:
+        raise RuntimeError("no import time reported for {}".format(module))
+
+    return seconds, modules
+
+def check_imports(repeat, budget_ms) -> list:
+    samples = []
+    modules = set()
+    for _ in range(repeat):
+        seconds, modules = import_time("main")
+        samples.append(seconds)
+
+    failures = []
+    loaded = sorted(m for m in IMPORT_FORBIDDEN if m in modules)
+    if len(loaded) > 0:
+        failures.append("'import main' loads {}".format(", ".join(loaded)))
+
+    # the fastest run is the least disturbed by the rest of the machine
+    if min(samples) * 1e3 > budget_ms:
+        failures.append("'import main' takes {:.1f}ms, budget {}ms".format(min(samples) * 1e3, budget_ms))
+
+    result = {
+        "min"       : min(samples),
+        "median"    : statistics.median(samples),
+        "mean"      : statistics.mean(samples),
+        "repeat"    : repeat,
+    }
+    print("{:<20} median {:10.6f}s  min {:10.6f}s".format("import_main", result["median"], result["min"]))
+
+    return result, failures
+
+def measure(fn, repeat) -> dict:
+    fn()    # warm up, page cache and lazily initialized state
+
+    samples = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - t)
+
+    return {
+        "min"       : min(samples),
+        "median"    : statistics.median(samples),
+        "mean"      : statistics.mean(samples),
+        "repeat"    : repeat,
+    }
+
+def run_benchmarks(work_dir, repeat, only=None) -> dict:
+    fmc, pb_dir = gen_inputs(work_dir)
+    out = path.join(work_dir, "out.bin")
+    ecc_path = path.join(BENCH_KEY_DIR, BENCH_ECC_KEY)
+
+    def selected(name):
+        return only is None or name in only
+
+    # keys are loaded only for the benchmarks which sign, the first LMS key
+    # load builds the Merkle tree of the key copy
+    lms_path = lms_key = lms_load = ecc_key = None
+    if selected("lms_sign") or selected("build_v2_signed"):
+        t = time.perf_counter()
+        lms_path = prepare_lms_key(work_dir)
+        lms_key = main.load_lms_key(lms_path)
+        lms_load = time.perf_counter() - t
+    if selected("ecc_sign"):
+        ecc_key = main.load_ecc_key(ecc_path)
+
+    fmc_info = main.gen_fmc_info(fmc[2], 1)
+    pbs_info = main.gen_prebuilt_info(pb_dir, PREBUILT_BIN)
+    body = main.gen_fmc_hdr_v2(fmc_info, pbs_info, 0, None, 0, None).output_body()
+
+    def hdr_serialize():
+        main.gen_fmc_hdr_v2(fmc_info, pbs_info, 0, None, 0, None).output()
+
+    def build(*argv):
+        return lambda: main.main(list(argv) + ["--output", out, "--prebuilt-dir", pb_dir, "--no-cache"])
+
+    benches = {
+        "gen_fmc_info"      : lambda: main.gen_fmc_info(fmc[2], 1),
+        "gen_prebuilt_info" : lambda: main.gen_prebuilt_info(pb_dir, PREBUILT_BIN),
+        "hdr_serialize"     : hdr_serialize,
+        "ecc_sign"          : lambda: main.ecc_sign_body(ecc_key, body),
+        "lms_sign"          : lambda: main.lms_sign_body(lms_key, body),
+        "build_v1"          : build("--input", fmc[1], "--version", "1"),
+        "build_v2"          : build("--input", fmc[2], "--version", "2"),
+        "build_v2_signed"   : build("--input", fmc[2], "--version", "2",
+                                    "--ecc-key", ecc_path, "--lms-key", lms_path),
+    }
+
+    results = {}
+    for name, fn in benches.items():
+        if not selected(name):
+            continue
+        results[name] = measure(fn, repeat)
+        print("{:<20} median {:10.6f}s  min {:10.6f}s".format(name, results[name]["median"], results[name]["min"]))
+
+    # informational, the first run builds the Merkle tree of the key copy
+    if lms_load is not None:
+        print("{:<20} {:10.6f}s".format("lms_key_load", lms_load))
+
+    return results
+
+def compare(results, baseline, threshold) -> list:
+    regressions = []
+
+    for name, r in results.items():
+        base = baseline.get("results", {}).get(name)
+        if base is None:
+            continue
+
+        ratio = r["median"] / base["median"] if base["median"] > 0 else 1.0
+        status = "REGRESSION" if ratio > 1 + threshold else "ok"
+        print("{:<20} {:10.6f}s -> {:10.6f}s  x{:.2f}  {}".format(name, base["median"], r["median"], ratio, status))
+
+        if status != "ok":
+            regressions.append(name)
+
+    return regressions
+
+def main_bench(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="benchmark FMC image generation")
+    parser.add_argument("--repeat", metavar="N", type=int, help="timed runs per benchmark, Default=20", default=20)
+    parser.add_argument("--only", metavar="NAME", action="append", help="run only the named benchmark, repeatable")
+    parser.add_argument("--output", metavar="FILE", help="write the results as JSON")
+    parser.add_argument("--baseline", metavar="FILE", help="baseline results, Default=bench/baseline.json", default=BENCH_BASELINE)
+    parser.add_argument("--save-baseline", help="store the results as the new baseline", action="store_true", default=False)
+    parser.add_argument("--threshold", metavar="R", type=float, help="allowed slowdown over the baseline median, Default=0.25", default=0.25)
+    parser.add_argument("--import-budget", metavar="MS", type=float, help="maximum 'import main' time, Default={}".format(IMPORT_BUDGET_MS), default=IMPORT_BUDGET_MS)
+    args = parser.parse_args(argv)
+
+    if args.repeat < 1:
+        parser.error("invalid number of runs={}".format(args.repeat))
+
+    failures = []
+    results = {}
+    if args.only is None or "import_main" in args.only:
+        results["import_main"], failures = check_imports(min(args.repeat, 10), args.import_budget)
+
+    work_dir = tempfile.mkdtemp(prefix="fmc_bench_")
+    try:
+        results.update(run_benchmarks(work_dir, args.repeat, args.only))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    for msg in failures:
+        print("FAILED {}".format(msg))
+
+    report = {
+        "python"    : platform.python_version(),
+        "machine"   : platform.machine(),
+        "platform"  : platform.platform(),
+        "results"   : results,
+    }
+
+    if args.output is not None:
+        f = open(args.output, "w")
+        json.dump(report, f, indent=2)
+        f.close()
+
+    if args.save_baseline:
+        f = open(args.baseline, "w")
+        json.dump(report, f, indent=2)
+        f.close()
+        print("baseline saved to {}".format(args.baseline))
+        return 1 if failures else 0
+
+    if not path.isfile(args.baseline):
+        print("no baseline {}, nothing to compare".format(args.baseline))
+        return 1 if failures else 0
+
+    f = open(args.baseline)
+    baseline = json.load(f)
+    f.close()
+
+    regressions = compare(results, baseline, args.threshold)
+    if len(regressions) > 0:
+        print("{} regression(s): {}".format(len(regressions), ", ".join(regressions)))
+        return 1
+
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main_bench())
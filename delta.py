@@ -0,0 +1,230 @@
+# Copyright (c) 2024 ASPEED Technology Inc.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Section level delta between two FMC images. A patch carries the new header
+# and, for each FMC/prebuilt section of the new image and each byte range
+# they leave uncovered, either the offset of an identical section in the old
+# image or the section data itself:
+#
+#   DELTA_HDR   magic, version, old size, new size, old SHA384, new SHA384,
+#               header size, number of sections
+#   header      the new header
+#   DELTA_SEC   kind, new offset, size, old offset, stored size, SHA384
+#               of each section, followed by the data of DELTA_DATA and
+#               DELTA_ZDATA sections in order
+
+import argparse
+import hashlib
+import struct
+import zlib
+from hdr_parse import MappedImage
+from hdr_parse import parse_image
+from image_io import AtomicFile
+
+DELTA_MAGIC = b'FMCD'
+DELTA_VERSION = 1
+DELTA_HDR = struct.Struct("<4sLQQ48s48sLL")
+DELTA_SEC = struct.Struct("<LQQQQ48s")
+
+DELTA_COPY = 0      # section found in the old image
+DELTA_DATA = 1      # section data stored as is
+DELTA_ZDATA = 2     # section data stored zlib compressed
+
+def image_sections(view, info) -> list:
+    # (offset, size, sha384) of the FMC and of each prebuilt; v2 headers
+    # record the digests, v1 sections are hashed
+    regions = [(info.fmc_offset, info.fmc_size)] + [(pb.offset, pb.size) for pb in info.prebuilts]
+
+    if info.version == 2:
+        dgsts = [info.fmc_dgst] + [pb.dgst for pb in info.prebuilts]
+    else:
+        dgsts = [hashlib.sha384(view[o : o + s]).digest() for o, s in regions]
+
+    return [(o, s, d) for (o, s), d in zip(regions, dgsts)]
+
+def patch_sections(view, info, label) -> list:
+    # image_sections() plus the bytes no section covers, a trailer after the
+    # last section or a gap, so that the patch rebuilds the whole image
+    secs = []
+    pos = info.hdr_size
+
+    for o, s, d in image_sections(view, info) + [(len(view), 0, None)]:
+        if o < pos:
+            raise RuntimeError("{}: section at {:#x} overlaps the previous one at {:#x}".format(label, o, pos))
+        if o > pos:
+            secs.append((pos, o - pos, hashlib.sha384(view[pos : o]).digest()))
+        if d is not None:
+            secs.append((o, s, d))
+        pos = o + s
+
+    return secs
+
+def _image_digest(view) -> bytes:
+    return hashlib.sha384(view).digest()
+
+def gen_delta(old_path, new_path, compress=True):
+    # returns (patch bytes, [(kind, size, stored size)] per section)
+    with MappedImage(old_path) as old, MappedImage(new_path) as new:
+        old_info = parse_image(old.view)
+        new_info = parse_image(new.view)
+
+        # the old sections are trusted only after checking their digest,
+        # so a corrupted base is never referenced
+        old_by_dgst = {}
+        for o, s, d in image_sections(old.view, old_info):
+            if old_info.version == 1 or hashlib.sha384(old.view[o : o + s]).digest() == d:
+                old_by_dgst.setdefault((d, s), o)
+
+        secs = []
+        data = []
+        for o, s, d in patch_sections(new.view, new_info, new_path):
+            if new_info.version == 2 and hashlib.sha384(new.view[o : o + s]).digest() != d:
+                raise RuntimeError("{}: section at {:#x} does not match its header digest".format(new_path, o))
+
+            old_ofst = old_by_dgst.get((d, s))
+            if old_ofst is not None:
+                secs.append(DELTA_SEC.pack(DELTA_COPY, o, s, old_ofst, 0, d))
+                continue
+
+            raw = bytes(new.view[o : o + s])
+            kind = DELTA_DATA
+            if compress:
+                z = zlib.compress(raw, 9)
+                if len(z) < len(raw):
+                    kind, raw = DELTA_ZDATA, z
+
+            secs.append(DELTA_SEC.pack(kind, o, s, 0, len(raw), d))
+            data.append(raw)
+
+        hdr = DELTA_HDR.pack(DELTA_MAGIC, DELTA_VERSION, len(old.view), len(new.view),
+                             _image_digest(old.view), _image_digest(new.view),
+                             new_info.hdr_size, len(secs))
+        patch = b''.join([hdr, bytes(new.view[: new_info.hdr_size])] + secs + data)
+
+    return patch, [DELTA_SEC.unpack(s)[0] for s in secs]
+
+def check_image(view):
+    # the rebuilt image must decode, and a v2 header must describe its
+    # sections; signatures are checked by 'verify'
+    info = parse_image(view)
+
+    if info.version == 2:
+        for o, s, d in image_sections(view, info):
+            if hashlib.sha384(view[o : o + s]).digest() != d:
+                raise RuntimeError("section at {:#x} does not match its header digest".format(o))
+
+    return info
+
+def apply_delta(old_path, patch, out_path):
+    view = memoryview(patch)
+
+    if len(view) < DELTA_HDR.size:
+        raise RuntimeError("invalid patch size={}".format(len(view)))
+
+    magic, ver, old_size, new_size, old_dgst, new_dgst, hdr_size, nsecs = DELTA_HDR.unpack_from(view, 0)
+    if magic != DELTA_MAGIC or ver != DELTA_VERSION:
+        raise RuntimeError("invalid patch magic={} version={}".format(magic, ver))
+
+    ofst = DELTA_HDR.size
+    hdr = view[ofst : ofst + hdr_size]
+    ofst += hdr_size
+    secs = [DELTA_SEC.unpack_from(view, ofst + i * DELTA_SEC.size) for i in range(nsecs)]
+    ofst += nsecs * DELTA_SEC.size
+
+    with MappedImage(old_path) as old:
+        if len(old.view) != old_size or _image_digest(old.view) != old_dgst:
+            raise RuntimeError("{} is not the image this patch was generated against".format(old_path))
+
+        with AtomicFile(out_path) as f:
+            h = hashlib.sha384(hdr)
+            f.write(hdr)
+            pos = hdr_size
+
+            for kind, new_ofst, size, old_ofst, stored, dgst in secs:
+                if new_ofst != pos:
+                    raise RuntimeError("invalid patch, section at {:#x} expected at {:#x}".format(new_ofst, pos))
+
+                if kind == DELTA_COPY:
+                    data = old.view[old_ofst : old_ofst + size]
+                elif kind == DELTA_DATA:
+                    data = view[ofst : ofst + stored]
+                    ofst += stored
+                elif kind == DELTA_ZDATA:
+                    data = zlib.decompress(view[ofst : ofst + stored])
+                    ofst += stored
+                else:
+                    raise RuntimeError("invalid patch section kind={}".format(kind))
+
+                try:
+                    if len(data) != size or hashlib.sha384(data).digest() != dgst:
+                        raise RuntimeError("patched section at {:#x} does not match its digest".format(new_ofst))
+
+                    h.update(data)
+                    f.write(data)
+                    pos += size
+                finally:
+                    # slices of the old image must be gone before it is
+                    # unmapped, also when the section is rejected
+                    if isinstance(data, memoryview):
+                        data.release()
+
+            if pos != new_size or h.digest() != new_dgst:
+                raise RuntimeError("patched image does not match the new image digest")
+
+            # checked before the rename, a rejected image never replaces
+            # the output
+            with MappedImage(f.tmp) as m:
+                return check_image(m.view)
+
+def cmd_diff(argv) -> int:
+    parser = argparse.ArgumentParser(prog="fmc-imgtool diff", description="generate a section level patch between two FMC images")
+    parser.add_argument("old", metavar="OLD", help="FMC binary with header currently deployed")
+    parser.add_argument("new", metavar="NEW", help="FMC binary with header to deploy")
+    parser.add_argument("--output", metavar="PATCH", help="patch file to write", required=True)
+    parser.add_argument("--no-compress", help="store changed sections uncompressed", action="store_true", default=False)
+    args = parser.parse_args(argv)
+
+    patch, kinds = gen_delta(args.old, args.new, not args.no_compress)
+
+    with AtomicFile(args.output) as f:
+        f.write(patch)
+
+    copied = sum(1 for k in kinds if k == DELTA_COPY)
+    new_size = DELTA_HDR.unpack_from(patch, 0)[3]
+    print("{} of {} sections changed, patch {} bytes for a {} bytes image".format(
+          len(kinds) - copied, len(kinds), len(patch), new_size))
+
+    return 0
+
+def cmd_apply(argv) -> int:
+    parser = argparse.ArgumentParser(prog="fmc-imgtool apply", description="rebuild an FMC image from the old image and a patch")
+    parser.add_argument("old", metavar="OLD", help="FMC binary with header the patch was generated against")
+    parser.add_argument("patch", metavar="PATCH", help="patch from 'diff'")
+    parser.add_argument("--output", metavar="OUT", help="output FMC binary with header", required=True)
+    args = parser.parse_args(argv)
+
+    f = open(args.patch, "rb")
+    patch = f.read()
+    f.close()
+
+    info = apply_delta(args.old, patch, args.output)
+    print("{}: version {} image, {} bytes".format(args.output, info.version, info.image_size))
+
+    return 0
@@ -0,0 +1,319 @@
+# Copyright (c) 2024 ASPEED Technology Inc.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Detached signing for keys kept on an offline signing station:
+#
+#   prepare      builds unsigned v2 images and a bundle with the header body
+#                and its SHA384 digest of each image
+#   sign-bundle  signs every body of a bundle with ECDSA384 and/or LMS keys,
+#                on the signing station
+#   attach       checks the returned signatures against the public keys and
+#                patches them into the preamble of each image in place
+#
+# The bundle is JSON: { "version" : 1, "images" : [ { "image", "body",
+# "sha384", "ecc_key_index", "lms_key_index" } ] }, sign-bundle adds
+# "ecc_signature" (r || s) and "lms_signature" (header layout) in hex.
+
+import argparse
+import hashlib
+import json
+import os
+from os import path
+from batch import BuildContext
+from batch import load_manifest
+from batch import make_spec
+from batch import SPEC_DEFAULTS
+from image_io import AtomicFile
+from main import gen_fmc_hdr_v2
+from main import write_image
+import hdr_v2
+
+BUNDLE_VERSION = 1
+
+def load_bundle(bundle_path) -> dict:
+    f = open(bundle_path, "r")
+    bundle = json.load(f)
+    f.close()
+
+    if bundle.get("version") != BUNDLE_VERSION:
+        raise RuntimeError("unsupported signing bundle {} version={}".format(bundle_path, bundle.get("version")))
+
+    for e in bundle["images"]:
+        body = bytes.fromhex(e["body"])
+        if len(body) != hdr_v2.HDR_BODY_SIZE:
+            raise RuntimeError("invalid header body length={} for {}".format(len(body), e["image"]))
+        if hashlib.sha384(body).hexdigest() != e["sha384"]:
+            raise RuntimeError("header body of {} does not match its SHA384 digest".format(e["image"]))
+
+    return bundle
+
+def save_bundle(bundle_path, bundle):
+    # a failed or interrupted write never leaves a truncated bundle behind
+    with AtomicFile(bundle_path) as f:
+        f.write(json.dumps(bundle, indent=2).encode())
+
+def prepare_images(specs, cache=None, jobs=1) -> dict:
+    ctx = BuildContext(cache, jobs)
+    bundle = { "version" : BUNDLE_VERSION, "images" : [] }
+
+    for spec in specs:
+        if spec["version"] != 2:
+            raise RuntimeError("{}: only version 2 headers carry signatures".format(spec["output"]))
+
+        # the signing keys are not known yet, nothing to resolve key_dir with
+        if spec["key_dir"] is not None and None in (spec["ecc_key_index"], spec["lms_key_index"]):
+            raise RuntimeError("{}: prepare needs explicit key indexes with key_dir".format(spec["output"]))
+
+        fmc_info = ctx.fmc_info(spec["input"], spec["svn"])
+        pbs_info = ctx.prebuilt_info(spec["prebuilt_dir"])
+        hdr = gen_fmc_hdr_v2(fmc_info, pbs_info, 0, None, 0, None)
+        write_image(spec["output"], hdr, fmc_info, pbs_info)
+
+        body = hdr.output_body()
+        bundle["images"].append({
+            "image"         : path.abspath(spec["output"]),
+            "body"          : body.hex(),
+            "sha384"        : hashlib.sha384(body).hexdigest(),
+            "ecc_key_index" : spec["ecc_key_index"] or 0,
+            "lms_key_index" : spec["lms_key_index"] or 0,
+        })
+
+    return bundle
+
+def sign_bundle(bundle, ecc_key=None, lms_key=None):
+    # one pass over the bundle, the LMS key leases all the leaves it needs
+    # at once
+    from main import ecc_sign_body
+    from main import lms_sign_body
+    from main import load_ecc_key
+    from main import load_lms_key
+    from lms_sign import LmsSigner
+
+    if ecc_key is not None:
+        ecc_key = load_ecc_key(ecc_key)
+
+    lease = None
+    if lms_key is not None:
+        lms_key = load_lms_key(lms_key)
+        if isinstance(lms_key, LmsSigner):
+            lease = lms_key = lms_key.reserve(len(bundle["images"]))
+
+    try:
+        for e in bundle["images"]:
+            body = bytes.fromhex(e["body"])
+
+            if ecc_key is not None:
+                sig_r, sig_s = ecc_sign_body(ecc_key, body)
+                e["ecc_signature"] = (sig_r + sig_s).hex()
+
+            if lms_key is not None:
+                e["lms_signature"] = lms_sign_body(lms_key, body).hex()
+    finally:
+        if lease is not None:
+            lease.release()
+
+def check_signatures(e, body, key_dir, ecc_pattern, lms_pattern) -> list:
+    from verify import load_ecc_pub
+    from verify import load_lms_pub
+    from verify import verify_ecc
+    from verify import verify_lms
+
+    reasons = []
+
+    if "ecc_signature" in e:
+        sig = bytes.fromhex(e["ecc_signature"])
+        key_path = path.join(key_dir, ecc_pattern.format(e["ecc_key_index"]))
+        if len(sig) != hdr_v2.ECC_KEY_LEN:
+            reasons.append("invalid ECDSA384 signature length={}".format(len(sig)))
+        elif not path.isfile(key_path):
+            reasons.append("no ECDSA384 key for index {}".format(e["ecc_key_index"]))
+        elif not verify_ecc(load_ecc_pub(key_path), body, sig):
+            reasons.append("ECDSA384 signature mismatch with key index {}".format(e["ecc_key_index"]))
+
+    if "lms_signature" in e:
+        sig = bytes.fromhex(e["lms_signature"])
+        key_path = path.join(key_dir, lms_pattern.format(e["lms_key_index"]))
+        if len(sig) != hdr_v2.LMS_KEY_LEN:
+            reasons.append("invalid LMS signature length={}".format(len(sig)))
+        elif not path.isfile(key_path):
+            reasons.append("no LMS key for index {}".format(e["lms_key_index"]))
+        else:
+            try:
+                if not verify_lms(load_lms_pub(key_path), body, sig):
+                    reasons.append("LMS signature mismatch with key index {}".format(e["lms_key_index"]))
+            except (RuntimeError, ValueError) as err:
+                reasons.append("invalid LMS signature: {}".format(err))
+
+    if not ("ecc_signature" in e or "lms_signature" in e):
+        reasons.append("no signature returned")
+
+    return reasons
+
+def patch_preamble(img_path, e):
+    # rewrite the preamble only, the body and the binaries stay as prepared
+    from hdr_v2 import FmcHdrV2
+
+    fd = os.open(img_path, os.O_RDWR)
+
+    try:
+        pre, _ = hdr_v2.PREAMBLE.unpack_from(os.pread(fd, hdr_v2.HDR_PREAMBLE_SIZE, 0))
+
+        hdr = FmcHdrV2()
+        hdr.set_ecc_key_index(pre["ecc_key_index"])
+        hdr.set_lms_key_index(pre["lms_key_index"])
+        hdr.set_ecc_signature(pre["ecc_signature"][: hdr_v2.ECC_KEY_LEN // 2], pre["ecc_signature"][hdr_v2.ECC_KEY_LEN // 2 :])
+        hdr.set_lms_signature(pre["lms_signature"])
+
+        if "ecc_signature" in e:
+            sig = bytes.fromhex(e["ecc_signature"])
+            hdr.set_ecc_key_index(e["ecc_key_index"])
+            hdr.set_ecc_signature(sig[: hdr_v2.ECC_KEY_LEN // 2], sig[hdr_v2.ECC_KEY_LEN // 2 :])
+
+        if "lms_signature" in e:
+            hdr.set_lms_key_index(e["lms_key_index"])
+            hdr.set_lms_signature(bytes.fromhex(e["lms_signature"]))
+
+        preamble = hdr.output_preamble()
+        if os.pwrite(fd, preamble, 0) != len(preamble):
+            raise RuntimeError("short write to {}".format(img_path))
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def attach_signatures(bundle, key_dir, ecc_pattern=None, lms_pattern=None) -> list:
+    # every image is checked before any is patched, images failing a check
+    # are left untouched
+    from hdr_parse import MappedImage
+    from hdr_parse import parse_image
+    from verify import ECC_PUB_PATTERN
+    from verify import LMS_PUB_PATTERN
+
+    ecc_pattern = ecc_pattern if ecc_pattern is not None else ECC_PUB_PATTERN
+    lms_pattern = lms_pattern if lms_pattern is not None else LMS_PUB_PATTERN
+
+    results = []
+    for e in bundle["images"]:
+        r = { "image" : e["image"], "reasons" : [] }
+        results.append(r)
+
+        body = bytes.fromhex(e["body"])
+        try:
+            with MappedImage(e["image"]) as m:
+                info = parse_image(m.view)
+                if info.version != 2:
+                    raise RuntimeError("version {} header carries no signature".format(info.version))
+                cur = bytes(m.view[hdr_v2.HDR_PREAMBLE_SIZE : hdr_v2.HDR_SIZE])
+        except (OSError, RuntimeError) as err:
+            r["reasons"].append(str(err))
+            continue
+
+        if cur != body:
+            r["reasons"].append("header body changed since prepare")
+            continue
+
+        r["reasons"] += check_signatures(e, body, key_dir, ecc_pattern, lms_pattern)
+
+    for e, r in zip(bundle["images"], results):
+        if len(r["reasons"]) == 0:
+            patch_preamble(e["image"], e)
+            r["status"] = "attached"
+        else:
+            r["status"] = "failed"
+
+    return results
+
+def cmd_prepare(argv) -> int:
+    parser = argparse.ArgumentParser(prog="fmc-imgtool prepare", description="build unsigned v2 images and a bundle of header bodies to sign")
+    parser.add_argument("--bundle", metavar="FILE", help="signing bundle to write", required=True)
+    parser.add_argument("--manifest", metavar="FILE", help="prepare all images listed in a JSON/TOML manifest")
+    parser.add_argument("--input", metavar="IN", help="input FMC raw binary")
+    parser.add_argument("--output", metavar="OUT", help="output FMC binary with header")
+    parser.add_argument("--svn", metavar="SVN", type=int, help="FMC security version number, Default=0", default=0)
+    parser.add_argument("--ecc-key-index", metavar="IDX", type=int, help="ECDSA384 signing key index hint, Default=0", default=0)
+    parser.add_argument("--lms-key-index", metavar="IDX", type=int, help="LMS signing key index hint, Default=0", default=0)
+    parser.add_argument("--prebuilt-dir", metavar="DIR", help="prebuilt binaries directory, Default=prebuilt/", default="prebuilt/")
+    parser.add_argument("--jobs", metavar="N", type=int, help="number of parallel input workers, Default=1", default=1)
+    args = parser.parse_args(argv)
+
+    if args.manifest is not None:
+        specs = load_manifest(args.manifest)
+    else:
+        for opt in ("input", "output"):
+            if getattr(args, opt) is None:
+                parser.error("the following arguments are required: --{} or --manifest".format(opt))
+
+        image = {
+            "input"         : args.input,
+            "output"        : args.output,
+            "version"       : 2,
+            "svn"           : args.svn,
+            "ecc_key_index" : args.ecc_key_index,
+            "lms_key_index" : args.lms_key_index,
+            "prebuilt_dir"  : args.prebuilt_dir,
+        }
+        specs = [make_spec(image, SPEC_DEFAULTS, os.getcwd(), "command line")]
+
+    bundle = prepare_images(specs, None, args.jobs)
+    save_bundle(args.bundle, bundle)
+    print("{} image(s) prepared in {}".format(len(bundle["images"]), args.bundle))
+
+    return 0
+
+def cmd_sign_bundle(argv) -> int:
+    parser = argparse.ArgumentParser(prog="fmc-imgtool sign-bundle", description="sign the header bodies of a signing bundle")
+    parser.add_argument("bundle", metavar="BUNDLE", help="signing bundle from 'prepare'")
+    parser.add_argument("--output", metavar="FILE", help="signed bundle to write", required=True)
+    parser.add_argument("--ecc-key", metavar="KEY", help="ECDSA384 signing key (.pem)")
+    parser.add_argument("--lms-key", metavar="KEY", help="LMS signing key (.prv)")
+    args = parser.parse_args(argv)
+
+    if args.ecc_key is None and args.lms_key is None:
+        parser.error("at least one of --ecc-key and --lms-key is required")
+
+    bundle = load_bundle(args.bundle)
+    sign_bundle(bundle, args.ecc_key, args.lms_key)
+    save_bundle(args.output, bundle)
+    print("{} image(s) signed in {}".format(len(bundle["images"]), args.output))
+
+    return 0
+
+def cmd_attach(argv) -> int:
+    from verify import ECC_PUB_PATTERN
+    from verify import LMS_PUB_PATTERN
+
+    parser = argparse.ArgumentParser(prog="fmc-imgtool attach", description="check and attach the signatures of a signed bundle to its images")
+    parser.add_argument("bundle", metavar="BUNDLE", help="signed bundle from 'sign-bundle'")
+    parser.add_argument("--key-dir", metavar="DIR", help="public keys directory, Default=keys/", default="keys/")
+    parser.add_argument("--ecc-pattern", metavar="FMT", help="ECDSA384 public key file name, Default={}".format(ECC_PUB_PATTERN), default=ECC_PUB_PATTERN)
+    parser.add_argument("--lms-pattern", metavar="FMT", help="LMS public key file name, Default={}".format(LMS_PUB_PATTERN), default=LMS_PUB_PATTERN)
+    args = parser.parse_args(argv)
+
+    results = attach_signatures(load_bundle(args.bundle), args.key_dir, args.ecc_pattern, args.lms_pattern)
+
+    for r in results:
+        if r["status"] == "attached":
+            print("OK     {}".format(r["image"]))
+        else:
+            print("FAILED {}: {}".format(r["image"], "; ".join(r["reasons"])))
+
+    failed = sum(1 for r in results if r["status"] != "attached")
+    print("{} attached, {} failed".format(len(results) - failed, failed))
+
+    return 1 if failed else 0
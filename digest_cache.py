@@ -0,0 +1,156 @@
+# Copyright (c) 2024 ASPEED Technology Inc.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import hashlib
+import os
+import sys
+import tempfile
+import threading
+from os import path
+
+CACHE_DGST_LEN = 48             # SHA384
+CACHE_MAX_ENTRIES = 4096        # 4096 * 48 bytes = 192KB of digests
+
+def default_cache_dir():
+    base = os.environ.get("XDG_CACHE_HOME") or path.join(path.expanduser("~"), ".cache")
+
+    return path.join(base, "fmc_imgtool", "digests")
+
+class DigestCache:
+    def __init__(self, cache_dir=None, max_entries=CACHE_MAX_ENTRIES, verify=False):
+        if max_entries <= 0:
+            raise RuntimeError("invalid digest cache size={}".format(max_entries))
+
+        self.cache_dir = cache_dir if cache_dir is not None else default_cache_dir()
+        self.max_entries = max_entries
+        self.verify = verify
+        self.hits = 0
+        self.misses = 0
+        self.mismatches = []
+
+        self.__lock = threading.Lock()
+        self.__trimmed = False
+
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+        except OSError:
+            pass
+
+    def key(self, file_path, st, pad=1) -> str:
+        # any write to the file changes ctime, which cannot be forged by utime()
+        k = "{}|{}|{}|{}|{}|{}|{}".format(path.realpath(file_path), st.st_dev, st.st_ino,
+                                          st.st_size, st.st_mtime_ns, st.st_ctime_ns, pad)
+
+        return hashlib.sha256(k.encode()).hexdigest()
+
+    def get(self, key):
+        entry = path.join(self.cache_dir, key)
+
+        try:
+            f = open(entry, "rb")
+            dgst = f.read()
+            f.close()
+        except OSError:
+            return None
+
+        if len(dgst) != CACHE_DGST_LEN:
+            return None
+
+        # entry is recently used, keep it away from eviction
+        try:
+            os.utime(entry)
+        except OSError:
+            pass
+
+        return dgst
+
+    def put(self, key, dgst):
+        if len(dgst) != CACHE_DGST_LEN:
+            raise RuntimeError("invalid digest length={}, expected {}".format(len(dgst), CACHE_DGST_LEN))
+
+        # write atomically, other builds may share the cache directory
+        # the cache is best effort, a read-only cache only costs a re-hash
+        try:
+            fd, tmp = tempfile.mkstemp(dir=self.cache_dir, prefix=".tmp")
+        except OSError:
+            return
+
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(dgst)
+            os.replace(tmp, path.join(self.cache_dir, key))
+        except OSError:
+            if path.exists(tmp):
+                os.unlink(tmp)
+            return
+
+        with self.__lock:
+            trim = not self.__trimmed
+            self.__trimmed = True
+
+        if trim:
+            self.trim()
+
+    def trim(self):
+        # evict the least recently used entries beyond the bound
+        entries = []
+        if not path.isdir(self.cache_dir):
+            return
+
+        for e in os.scandir(self.cache_dir):
+            if e.name.startswith(".tmp"):
+                continue
+            try:
+                entries.append((e.stat().st_mtime_ns, e.path))
+            except OSError:
+                pass
+
+        if len(entries) <= self.max_entries:
+            return
+
+        entries.sort()
+        for _, e in entries[: len(entries) - self.max_entries]:
+            try:
+                os.unlink(e)
+            except OSError:
+                pass
+
+    def file_digest(self, f, file_path, compute, pad=1) -> bytes:
+        key = self.key(file_path, os.fstat(f.fileno()), pad)
+        cached = self.get(key)
+
+        if cached is not None and not self.verify:
+            with self.__lock:
+                self.hits += 1
+            return cached
+
+        dgst = compute()
+
+        with self.__lock:
+            self.misses += 1
+            if cached is not None and cached != dgst:
+                self.mismatches.append(file_path)
+
+        if cached is not None and cached != dgst:
+            print("digest cache mismatch: {}".format(file_path), file=sys.stderr)
+
+        self.put(key, dgst)
+
+        return dgst
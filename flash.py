@@ -0,0 +1,215 @@
+# Copyright (c) 2024 ASPEED Technology Inc.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# A partition map describes the whole SPI flash:
+#
+#   {
+#     "size": "64M", "fill": 255,
+#     "partitions": [
+#       { "name": "fmc",    "offset": 0,         "size": "1M",   "file": "fmc.bin", "fmc": true },
+#       { "name": "u-boot", "offset": "0x100000", "size": "1M",   "file": "u-boot.bin" },
+#       { "name": "env",    "offset": "0x200000", "size": "64K",  "fill": 0 }
+#     ]
+#   }
+#
+# Sizes and offsets are integers or strings, hex and K/M/G suffixes allowed.
+# Bytes outside any partition and behind each file take the flash "fill"
+# (0xff by default, erased NOR) or the partition "fill".
+
+import argparse
+import json
+import os
+from os import path
+from image_io import AtomicFile
+from image_io import CHUNK_SIZE
+from image_io import write_fd
+
+FLASH_FILL = 0xff
+FLASH_UNITS = { "K" : 1 << 10, "M" : 1 << 20, "G" : 1 << 30 }
+
+class Partition:
+    pass
+
+def _num(v, what) -> int:
+    if isinstance(v, str):
+        unit = FLASH_UNITS.get(v[-1 :].upper(), 1)
+        try:
+            v = int(v[: -1] if unit > 1 else v, 0) * unit
+        except ValueError:
+            raise RuntimeError("invalid {} '{}'".format(what, v))
+
+    if not isinstance(v, int) or isinstance(v, bool) or v < 0:
+        raise RuntimeError("invalid {} '{}'".format(what, v))
+
+    return v
+
+def _fill(v, what) -> int:
+    if not isinstance(v, int) or isinstance(v, bool) or v < 0 or v > 0xff:
+        raise RuntimeError("invalid {} fill '{}', expected 0 ~ 255".format(what, v))
+
+    return v
+
+def load_flash_map(map_path, files=None):
+    # returns (flash size, fill, partitions sorted by offset); files maps
+    # partition names to the file replacing the one of the map
+    if map_path.endswith(".toml"):
+        try:
+            import tomllib
+        except ImportError:
+            raise RuntimeError("TOML partition map requires python 3.11 or above")
+
+        f = open(map_path, "rb")
+        doc = tomllib.load(f)
+    else:
+        f = open(map_path, "r")
+        doc = json.load(f)
+
+    f.close()
+
+    # relative paths are resolved against the map location
+    base_dir = path.dirname(path.abspath(map_path))
+    files = dict(files or {})
+
+    flash_size = _num(doc.get("size"), "flash size")
+    fill = _fill(doc.get("fill", FLASH_FILL), "flash")
+
+    parts = []
+    for i, p in enumerate(doc.get("partitions", [])):
+        part = Partition()
+        part.name = p.get("name", "#{}".format(i))
+        part.offset = _num(p.get("offset"), "{} offset".format(part.name))
+        part.size = _num(p.get("size"), "{} size".format(part.name))
+        part.fill = _fill(p.get("fill", fill), part.name)
+        part.fmc = bool(p.get("fmc", False))
+        part.file = files.pop(part.name, None)
+        if part.file is None and p.get("file") is not None:
+            part.file = path.join(base_dir, p["file"])
+        parts.append(part)
+
+    if len(files) > 0:
+        raise RuntimeError("unknown partition {} in {}".format(", ".join(sorted(files)), map_path))
+
+    parts.sort(key=lambda part: part.offset)
+
+    return flash_size, fill, parts
+
+def check_flash_map(flash_size, parts):
+    # every partition lies within the flash, no two partitions overlap and
+    # every file fits its partition; FMC images are checked through their header
+    from hdr_parse import MappedImage
+    from hdr_parse import parse_image
+
+    end = 0
+    prev = None
+    for part in parts:
+        if part.offset + part.size > flash_size:
+            raise RuntimeError("partition {} [{:#x}, {:#x}) exceeds flash size {:#x}".format(
+                               part.name, part.offset, part.offset + part.size, flash_size))
+
+        if part.offset < end:
+            raise RuntimeError("partition {} at {:#x} overlaps {} ending at {:#x}".format(
+                               part.name, part.offset, prev.name, end))
+
+        end = part.offset + part.size
+        prev = part
+
+        part.data_size = 0
+        if part.file is None:
+            continue
+
+        if part.fmc:
+            # header and sections as the FMC ROM will read them
+            with MappedImage(part.file) as img:
+                info = parse_image(img.view)
+            layout_end = info.fmc_offset + info.fmc_size + sum(pb.size for pb in info.prebuilts)
+            if layout_end > part.size:
+                raise RuntimeError("partition {} size {:#x} too small for FMC image {}, header describes {:#x}".format(
+                                   part.name, part.size, part.file, layout_end))
+
+        part.data_size = os.stat(part.file).st_size
+        if part.data_size > part.size:
+            raise RuntimeError("partition {} size {:#x} too small for {} of {:#x} bytes".format(
+                               part.name, part.size, part.file, part.data_size))
+
+def _fill_range(fd, ofst, size, fill):
+    # zero is left as a hole of the sparse output
+    if fill == 0 or size == 0:
+        return 0
+
+    buf = bytes([fill]) * min(size, CHUNK_SIZE)
+    os.lseek(fd, ofst, os.SEEK_SET)
+
+    left = size
+    while left > 0:
+        n = min(left, len(buf))
+        write_fd(fd, memoryview(buf)[: n])
+        left -= n
+
+    return size
+
+def write_flash(out_path, flash_size, fill, parts) -> dict:
+    # returns the number of bytes copied, filled and left as holes
+    stats = { "size" : flash_size, "data" : 0, "filled" : 0 }
+
+    with AtomicFile(out_path) as out:
+        # the whole image starts as a hole, reading back as zeros
+        os.ftruncate(out.fd, flash_size)
+
+        pos = 0
+        for part in parts:
+            stats["filled"] += _fill_range(out.fd, pos, part.offset - pos, fill)
+
+            if part.file is not None:
+                os.lseek(out.fd, part.offset, os.SEEK_SET)
+                out.copy_from(part.file, part.data_size)
+                stats["data"] += part.data_size
+
+            stats["filled"] += _fill_range(out.fd, part.offset + part.data_size,
+                                           part.size - part.data_size, part.fill)
+            pos = part.offset + part.size
+
+        stats["filled"] += _fill_range(out.fd, pos, flash_size - pos, fill)
+
+    stats["sparse"] = flash_size - stats["data"] - stats["filled"]
+
+    return stats
+
+def cmd_flash(argv) -> int:
+    parser = argparse.ArgumentParser(prog="fmc-imgtool flash", description="assemble a full SPI flash image from a partition map")
+    parser.add_argument("map", metavar="MAP", help="JSON/TOML partition map")
+    parser.add_argument("--output", metavar="OUT", help="output flash image", required=True)
+    parser.add_argument("--file", metavar="NAME=FILE", help="use FILE for partition NAME instead of the map", action="append", default=[])
+    args = parser.parse_args(argv)
+
+    files = {}
+    for f in args.file:
+        name, sep, file_path = f.partition("=")
+        if not sep or not name or not file_path:
+            parser.error("invalid --file '{}', expected NAME=FILE".format(f))
+        files[name] = file_path
+
+    flash_size, fill, parts = load_flash_map(args.map, files)
+    check_flash_map(flash_size, parts)
+    stats = write_flash(args.output, flash_size, fill, parts)
+
+    print("{}: {} bytes, {} data, {} filled, {} sparse".format(
+          args.output, stats["size"], stats["data"], stats["filled"], stats["sparse"]))
+
+    return 0
@@ -19,24 +19,124 @@
 # SOFTWARE.
 
 import abc
+import struct
 
 HDR_MAGIC = 0x48545341  # ASTH
 
+class HdrLayout:
+    # fixed little-endian fields followed by an optional table of entries,
+    # zero-filled up to size; fields and entry are [(name, struct format)]
+    def __init__(self, name: str, size: int, fields, entry=None):
+        self.name = name
+        self.size = size
+        self.names = tuple(name for name, _ in fields)
+        self.struct = struct.Struct("<" + "".join(fmt for _, fmt in fields))
+
+        if self.struct.size > size:
+            raise RuntimeError("invalid {} layout size={}, expected <= {}".format(name, self.struct.size, size))
+
+        self.entry_names = ()
+        self.entry = None
+        self.max_entries = 0
+        if entry is not None:
+            self.entry_names = tuple(name for name, _ in entry)
+            self.entry = struct.Struct("<" + "".join(fmt for _, fmt in entry))
+            self.max_entries = (size - self.struct.size) // self.entry.size
+
+    def pack_into(self, buf, ofst: int, values: dict, entries=()):
+        # buf is expected to be zero-filled, only the used bytes are written
+        used = self.struct.size
+        if self.entry is not None:
+            used += len(entries) * self.entry.size
+        if used > self.size or (self.entry is None and len(entries) > 0):
+            raise RuntimeError("invalid {} size={}, expected <= {}".format(self.name, used, self.size))
+
+        self.struct.pack_into(buf, ofst, *[values[name] for name in self.names])
+
+        pos = ofst + self.struct.size
+        for e in entries:
+            self.entry.pack_into(buf, pos, *e)
+            pos += self.entry.size
+
+    def unpack_from(self, buf, ofst: int = 0, end=None):
+        # returns (fields, entries); the table stops at the first entry whose
+        # first field equals end, or at the end of the layout
+        values = dict(zip(self.names, self.struct.unpack_from(buf, ofst)))
+
+        entries = []
+        if self.entry is not None:
+            pos = ofst + self.struct.size
+            for _ in range(self.max_entries):
+                e = self.entry.unpack_from(buf, pos)
+                if end is not None and e[0] == end:
+                    break
+                entries.append(e)
+                pos += self.entry.size
+
+        return values, entries
+
 class FmcHdrMeta(metaclass=abc.ABCMeta):
+    # PREAMBLE and BODY are the HdrLayout of each version
+    PREAMBLE = None
+    BODY = None
 
     def __init__(self):
         # common fields across all versions of FMC header
         self.magic = HDR_MAGIC
         self.version = 0xffffffff
+        self._body = None
+
+    def _invalidate_body(self):
+        # every body setter must call this, the body is signed as serialized
+        self._body = None
 
     @abc.abstractmethod
-    def output_preamble(self, verbose: bool = False):
+    def preamble_fields(self) -> dict:
         return NotImplemented
 
     @abc.abstractmethod
-    def output_body(self, verbose : bool = False):
+    def body_fields(self) -> dict:
         return NotImplemented
 
     @abc.abstractmethod
-    def output(self, verbose : bool = False):
+    def body_entries(self) -> list:
+        return NotImplemented
+
+    @abc.abstractmethod
+    def print_preamble(self):
         return NotImplemented
+
+    @abc.abstractmethod
+    def print_body(self):
+        return NotImplemented
+
+    def output_preamble(self, verbose: bool = False):
+        if verbose:
+            self.print_preamble()
+
+        preamble = bytearray(self.PREAMBLE.size)
+        self.PREAMBLE.pack_into(preamble, 0, self.preamble_fields())
+
+        return preamble
+
+    def output_body(self, verbose : bool = False):
+        if verbose:
+            self.print_body()
+
+        # serialized once, until a body setter changes a field
+        if self._body is None:
+            body = bytearray(self.BODY.size)
+            self.BODY.pack_into(body, 0, self.body_fields(), self.body_entries())
+            self._body = bytes(body)
+
+        return self._body
+
+    def output(self, verbose : bool = False):
+        hdr = bytearray(self.PREAMBLE.size + self.BODY.size)
+
+        if verbose:
+            self.print_preamble()
+        self.PREAMBLE.pack_into(hdr, 0, self.preamble_fields())
+        hdr[self.PREAMBLE.size :] = self.output_body(verbose)
+
+        return hdr
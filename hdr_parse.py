@@ -0,0 +1,245 @@
+# Copyright (c) 2024 ASPEED Technology Inc.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import argparse
+import json
+import mmap
+import os
+import struct
+from os import path
+from hdr_meta import HDR_MAGIC
+from prebuilt import PrebuiltType
+from prebuilt import PREBUILT_BIN
+
+PREBUILT_NAME = { pb_type.value : name for name, pb_type in PREBUILT_BIN.items() }
+
+class PrebuiltEntry:
+    pass
+
+class HdrInfo:
+    def to_dict(self) -> dict:
+        d = {
+            "version"       : self.version,
+            "image_size"    : self.image_size,
+            "header_size"   : self.hdr_size,
+            "fmc_offset"    : self.fmc_offset,
+            "fmc_size"      : self.fmc_size,
+        }
+
+        if self.version == 2:
+            d["fmc_svn"] = self.fmc_svn
+            d["fmc_digest"] = self.fmc_dgst.hex()
+            d["ecc_key_index"] = self.ecc_key_index
+            d["lms_key_index"] = self.lms_key_index
+            d["ecc_signed"] = any(self.ecc_signature)
+            d["lms_signed"] = any(self.lms_signature)
+
+        d["prebuilts"] = []
+        for pb in self.prebuilts:
+            e = { "type" : pb.type, "name" : pb.name, "offset" : pb.offset, "size" : pb.size }
+            if self.version == 2:
+                e["digest"] = pb.dgst.hex()
+            d["prebuilts"].append(e)
+
+        return d
+
+def parse_image(buf) -> HdrInfo:
+    # decode the header in place, buf is any buffer (bytes, mmap, memoryview)
+    # and only the header fields are copied out of it
+    view = memoryview(buf)
+
+    try:
+        return _parse_image(view)
+    finally:
+        view.release()
+
+def _parse_image(view) -> HdrInfo:
+    if len(view) < 8:
+        raise RuntimeError("invalid image size={}, too small for a header".format(len(view)))
+
+    magic, version = struct.unpack_from("<2L", view, 0)
+    if magic != HDR_MAGIC:
+        raise RuntimeError("invalid header magic={}, expected {}".format(hex(magic), hex(HDR_MAGIC)))
+
+    # only the header module of this version is loaded
+    if version == 1:
+        import hdr_v1 as hdr
+    elif version == 2:
+        import hdr_v2 as hdr
+    else:
+        raise RuntimeError("invalid FMC header version={}".format(version))
+
+    if len(view) < hdr.HDR_SIZE:
+        raise RuntimeError("invalid image size={}, expected >= {}".format(len(view), hdr.HDR_SIZE))
+
+    info = HdrInfo()
+    info.version = version
+    info.image_size = len(view)
+    info.hdr_size = hdr.HDR_SIZE
+    info.fmc_offset = hdr.HDR_SIZE
+
+    # same layouts as used to generate the header
+    preamble, _ = hdr.PREAMBLE.unpack_from(view, 0)
+    body, entries = hdr.BODY.unpack_from(view, hdr.HDR_PREAMBLE_SIZE, PrebuiltType.PREBUILT_TYPE_END)
+
+    info.fmc_size = body["size"]
+    if version == 2:
+        info.ecc_key_index = preamble["ecc_key_index"]
+        info.lms_key_index = preamble["lms_key_index"]
+        info.ecc_signature = preamble["ecc_signature"]
+        info.lms_signature = preamble["lms_signature"]
+        info.fmc_svn = body["svn"]
+        info.fmc_dgst = body["dgst"]
+
+    if info.fmc_size > hdr.HDR_MAX_FMCSZ:
+        raise RuntimeError("invalid image size={}, maximum {}".format(info.fmc_size, hdr.HDR_MAX_FMCSZ))
+
+    # prebuilt table ends at PREBUILT_TYPE_END or at the end of the body
+    info.prebuilts = []
+    pb_ofst = info.fmc_offset + info.fmc_size
+    for e in entries:
+        pb_type, pb_size = e[0], e[1]
+        if not (pb_type in iter(PrebuiltType)):
+            raise RuntimeError("invalid prebuilt binary type={}".format(pb_type))
+
+        pb = PrebuiltEntry()
+        pb.type = pb_type
+        pb.name = PREBUILT_NAME.get(pb_type)
+        pb.offset = pb_ofst
+        pb.size = pb_size
+        if version == 2:
+            pb.dgst = e[2]
+
+        info.prebuilts.append(pb)
+
+        pb_ofst += pb_size
+
+    if pb_ofst > len(view):
+        raise RuntimeError("truncated image size={}, header describes {}".format(len(view), pb_ofst))
+
+    return info
+
+class MappedImage:
+    # read-only mapping of an image file, slices of .view do not copy
+    def __init__(self, img_path):
+        self.__f = open(img_path, "rb")
+
+        size = os.fstat(self.__f.fileno()).st_size
+        if size == 0:
+            self.__f.close()
+            raise RuntimeError("empty image {}".format(img_path))
+
+        self.__mm = mmap.mmap(self.__f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.__mm)
+
+    def close(self):
+        self.view.release()
+        self.__mm.close()
+        self.__f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+        return False
+
+def print_info(info):
+    print("--------------")
+    print("PREAMBLE")
+    print("--------------")
+    print("MAGIC                    : {}".format(hex(HDR_MAGIC)))
+    print("VERSION                  : {}".format(hex(info.version)))
+    if info.version == 2:
+        print("ECC_KEY_INDEX            : {}".format(hex(info.ecc_key_index)))
+        print("LMS_KEY_INDEX            : {}".format(hex(info.lms_key_index)))
+        print("ECC_SIGNATURE (32 MSByte): {}".format(info.ecc_signature.hex()[: 64]))
+        print("LMS_SIGNATURE (32 MSByte): {}".format(info.lms_signature.hex()[: 64]))
+    print("--------------")
+    print("BODY")
+    print("--------------")
+    print("FMC SIZE                 : {}".format(hex(info.fmc_size)))
+    if info.version == 2:
+        print("FMC SVN                  : {}".format(hex(info.fmc_svn)))
+        print("FMC DIGEST               : {}".format(info.fmc_dgst.hex()))
+    for pb in info.prebuilts:
+        print("Prebuilt Type            : {}".format(hex(pb.type)))
+        print("Prebuilt Offset          : {}".format(hex(pb.offset)))
+        print("Prebuilt Size            : {}".format(hex(pb.size)))
+        if info.version == 2:
+            print("Prebuilt Digest          : {}".format(pb.dgst.hex()))
+
+def cmd_inspect(argv) -> int:
+    parser = argparse.ArgumentParser(prog="fmc-imgtool inspect", description="decode the header of FMC images")
+    parser.add_argument("images", metavar="IMG", nargs="+", help="FMC binary with header")
+    parser.add_argument("--json", help="print JSON instead of text", action="store_true", default=False)
+    args = parser.parse_args(argv)
+
+    rc = 0
+    results = []
+    for img in args.images:
+        try:
+            with MappedImage(img) as m:
+                info = parse_image(m.view)
+        except (OSError, RuntimeError) as e:
+            rc = 1
+            results.append({ "image" : img, "error" : str(e) })
+            if not args.json:
+                print("{}: {}".format(img, e))
+            continue
+
+        d = info.to_dict()
+        d["image"] = img
+        results.append(d)
+
+        if not args.json:
+            print("{}:".format(img))
+            print_info(info)
+
+    if args.json:
+        print(json.dumps(results if len(results) > 1 else results[0], indent=2))
+
+    return rc
+
+def cmd_extract(argv) -> int:
+    parser = argparse.ArgumentParser(prog="fmc-imgtool extract", description="extract the FMC and prebuilt binaries of an FMC image")
+    parser.add_argument("image", metavar="IMG", help="FMC binary with header")
+    parser.add_argument("--output-dir", metavar="DIR", help="output directory, Default=.", default=".")
+    args = parser.parse_args(argv)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    with MappedImage(args.image) as m:
+        info = parse_image(m.view)
+
+        # the FMC is extracted with its alignment padding, as covered by the digest
+        sections = [("fmc.bin", info.fmc_offset, info.fmc_size)]
+        for pb in info.prebuilts:
+            name = pb.name if pb.name is not None else "prebuilt_{}.bin".format(pb.type)
+            sections.append((name, pb.offset, pb.size))
+
+        for name, ofst, size in sections:
+            f = open(path.join(args.output_dir, name), "wb")
+            f.write(m.view[ofst : ofst + size])
+            f.close()
+            print("{:<28} offset {:#010x} size {:#x}".format(name, ofst, size))
+
+    return 0
@@ -20,14 +20,28 @@
 
 from hdr_meta import *
 from prebuilt import PrebuiltType
-import struct
 
 HDR_PREAMBLE_SIZE = 0x8                         # 8
 HDR_BODY_SIZE = 0x78                            # 120
 HDR_SIZE = HDR_PREAMBLE_SIZE + HDR_BODY_SIZE    # 128
 HDR_MAX_FMCSZ = 0x16000                         # 88KB
 
+PREAMBLE = HdrLayout("preamble", HDR_PREAMBLE_SIZE, [
+    ("magic",   "L"),
+    ("version", "L"),
+])
+
+BODY = HdrLayout("body", HDR_BODY_SIZE, [
+    ("size",    "L"),
+], entry=[
+    ("type",    "L"),
+    ("size",    "L"),
+])
+
 class FmcHdrV1(FmcHdrMeta):
+    PREAMBLE = PREAMBLE
+    BODY = BODY
+
     def __init__(self):
         super().__init__()
 
@@ -43,6 +57,7 @@ class FmcHdrV1(FmcHdrMeta):
             raise RuntimeError("invalid image size={}, maximum {}".format(sz, HDR_MAX_FMCSZ))
 
         self.__size = sz
+        self._invalidate_body()
 
     def add_prebuilt(self, pb_type: int, pb_size: int):
         if not (pb_type in iter(PrebuiltType)):
@@ -53,62 +68,34 @@ class FmcHdrV1(FmcHdrMeta):
 
         # (type, size)
         self.__prebuilt.append((pb_type, pb_size))
+        self._invalidate_body()
 
-    def output_preamble(self, verbose : bool = False):
-        preamble = bytearray(HDR_PREAMBLE_SIZE)
-
-        # print preamble if needed
-        if verbose:
-            print("--------------")
-            print("PREAMBLE")
-            print("--------------")
-            print("MAGIC                    : {}".format(hex(self.magic)))
-            print("VERSION                  : {}".format(hex(self.version)))
-
-        tmp = struct.pack("<2L", self.magic, self.version)
-
-        tmp_len = len(tmp)
-        if tmp_len > HDR_PREAMBLE_SIZE:
-            raise RuntimeError("invalid preamble size={}, expected <= {}".format(tmp_len, HDR_PREAMBLE_SIZE))
-
-        preamble[: len(tmp)] = tmp
+    def preamble_fields(self) -> dict:
+        return { "magic" : self.magic, "version" : self.version }
 
-        return preamble
+    def body_fields(self) -> dict:
+        return { "size" : self.__size }
 
-    def output_body(self, verbose : bool = False):
-        body = bytearray(HDR_BODY_SIZE)
-        tmp = bytearray()
+    def body_entries(self) -> list:
+        return self.__prebuilt
 
-        tmp = struct.pack("<L", self.__size)
+    def print_preamble(self):
+        print("--------------")
+        print("PREAMBLE")
+        print("--------------")
+        print("MAGIC                    : {}".format(hex(self.magic)))
+        print("VERSION                  : {}".format(hex(self.version)))
 
-        if verbose:
-            print("--------------")
-            print("BODY")
-            print("--------------")
-            print("FMC SIZE                 : {}".format(hex(self.__size)))
+    def print_body(self):
+        print("--------------")
+        print("BODY")
+        print("--------------")
+        print("FMC SIZE                 : {}".format(hex(self.__size)))
 
         ofst = HDR_SIZE + self.__size
         for pb in self.__prebuilt:
-            # (type, size)
-            tmp += struct.pack("<2L", pb[0], pb[1])
-
-            if verbose:
-                print("Prebuilt Type            : {}".format(hex(pb[0])))
-                print("Prebuilt Offset          : {}".format(hex(ofst)))
-                print("Prebuilt Size            : {}".format(hex(pb[1])))
+            print("Prebuilt Type            : {}".format(hex(pb[0])))
+            print("Prebuilt Offset          : {}".format(hex(ofst)))
+            print("Prebuilt Size            : {}".format(hex(pb[1])))
 
             ofst += pb[1]
-
-        tmp_len = len(tmp)
-        if tmp_len > HDR_BODY_SIZE:
-            raise RuntimeError("invalid body size={}, expected <= {}".format(tmp_len, HDR_BODY_SIZE))
-
-        body[: tmp_len] = tmp
-
-        return body
-
-    def output(self, verbose : bool = False):
-        preamble = self.output_preamble(verbose)
-        body = self.output_body(verbose)
-
-        return preamble + body
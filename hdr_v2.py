@@ -20,7 +20,6 @@
 
 from hdr_meta import *
 from prebuilt import PrebuiltType
-import struct
 
 ECC_KEY_LEN = 96            # ECDSA384
 LMS_KEY_LEN = 1620          # LMS_SHA256_N24_H15 + LMOTS_SHA256_N24_W4
@@ -33,7 +32,29 @@ HDR_MAX_SVN = 64                                # correspond to 64-bits bitmap i
 HDR_MAX_KEYID = 16                              # correspond to 16-bits bitmap in OTP
 HDR_MAX_FMCSZ = 0x38000                         # 224KB
 
+PREAMBLE = HdrLayout("preamble", HDR_PREAMBLE_SIZE, [
+    ("magic",           "L"),
+    ("version",         "L"),
+    ("ecc_key_index",   "L"),
+    ("lms_key_index",   "L"),
+    ("ecc_signature",   "{}s".format(ECC_KEY_LEN)),
+    ("lms_signature",   "{}s".format(LMS_KEY_LEN)),
+])
+
+BODY = HdrLayout("body", HDR_BODY_SIZE, [
+    ("svn",             "L"),
+    ("size",            "L"),
+    ("dgst",            "{}s".format(SHA_DGST_LEN)),
+], entry=[
+    ("type",            "L"),
+    ("size",            "L"),
+    ("dgst",            "{}s".format(SHA_DGST_LEN)),
+])
+
 class FmcHdrV2(FmcHdrMeta):
+    PREAMBLE = PREAMBLE
+    BODY = BODY
+
     def __init__(self):
         super().__init__()
 
@@ -80,7 +101,7 @@ class FmcHdrV2(FmcHdrMeta):
         if len(s) < LMS_KEY_LEN:
             raise RuntimeError("invalid LMS N24/H15/W4 length={}, expected {}".format(len(s), LMS_KEY_LEN))
 
-        self.__lms_signature[: LMS_KEY_LEN] = s
+        self.__lms_signature[: LMS_KEY_LEN] = s[: LMS_KEY_LEN]
 
     # Body field accessor
     def set_fmc_svn(self, v: int):
@@ -88,18 +109,21 @@ class FmcHdrV2(FmcHdrMeta):
             raise RuntimeError("invalid SVN={}, maximum {}".format(v, HDR_MAX_SVN))
 
         self.__svn = v
+        self._invalidate_body()
 
     def set_fmc_size(self, sz: int):
         if sz < 0 or sz > HDR_MAX_FMCSZ:
             raise RuntimeError("invalid image size={}, maximum {}".format(sz, HDR_MAX_FMCSZ))
 
         self.__size = sz
+        self._invalidate_body()
 
     def set_fmc_digest(self, dgst: bytearray):
         if len(dgst) < SHA_DGST_LEN:
             raise RuntimeError("invalid SHA384 digest length={}, expected {}".format(len(dgst), SHA_DGST_LEN))
 
-        self.__sha384_dgst[: SHA_DGST_LEN] = dgst
+        self.__sha384_dgst[: SHA_DGST_LEN] = dgst[: SHA_DGST_LEN]
+        self._invalidate_body()
 
     def add_prebuilt(self, pb_type: int, pb_size: int, pb_dgst: bytearray):
         if not (pb_type in iter(PrebuiltType)):
@@ -112,73 +136,49 @@ class FmcHdrV2(FmcHdrMeta):
             raise RuntimeError("invalid prebuilt binary digest length={}".format(len(pb_dgst)))
 
         # (type, size, dgst)
-        self.__prebuilt.append((pb_type, pb_size, pb_dgst[: SHA_DGST_LEN]))
-
-    def output_preamble(self, verbose: bool = False):
-        preamble = bytearray(HDR_PREAMBLE_SIZE)
-
-        # print preamble if needed
-        if verbose:
-            print("--------------")
-            print("PREAMBLE")
-            print("--------------")
-            print("MAGIC                    : {}".format(hex(self.magic)))
-            print("VERSION                  : {}".format(hex(self.version)))
-            print("ECC_KEY_INDEX            : {}".format(hex(self.__ecc_key_index)))
-            print("LMS_KEY_INDEX            : {}".format(hex(self.__lms_key_index)))
-            print("ECC_SIGNATURE (32 MSByte): {}".format(self.__ecc_signature.hex()[: 64]))
-            print("LMS_SIGNATURE (32 MSByte): {}".format(self.__lms_signature.hex()[: 64]))
-
-        tmp = struct.pack("<4L", self.magic, self.version, self.__ecc_key_index, self.__lms_key_index)
-        tmp += self.__ecc_signature
-        tmp += self.__lms_signature
-
-        tmp_len = len(tmp)
-        if tmp_len > HDR_PREAMBLE_SIZE:
-            raise RuntimeError("invalid preamble size={}, expected <= {}".format(tmp_len, HDR_PREAMBLE_SIZE))
-
-        preamble[: tmp_len] = tmp
-
-        return preamble
-
-    def output_body(self, verbose : bool = False):
-        body = bytearray(HDR_BODY_SIZE)
-
-        tmp = struct.pack("<2L", self.__svn, self.__size)
-        tmp += self.__sha384_dgst
-
-        if verbose:
-            print("--------------")
-            print("BODY")
-            print("--------------")
-            print("FMC SIZE                 : {}".format(hex(self.__size)))
-            print("FMC SVN                  : {}".format(hex(self.__svn)))
-            print("FMC DIGEST               : {}".format(self.__sha384_dgst.hex()))
+        self.__prebuilt.append((pb_type, pb_size, bytes(pb_dgst[: SHA_DGST_LEN])))
+        self._invalidate_body()
+
+    def preamble_fields(self) -> dict:
+        return {
+            "magic"         : self.magic,
+            "version"       : self.version,
+            "ecc_key_index" : self.__ecc_key_index,
+            "lms_key_index" : self.__lms_key_index,
+            "ecc_signature" : bytes(self.__ecc_signature),
+            "lms_signature" : bytes(self.__lms_signature),
+        }
+
+    def body_fields(self) -> dict:
+        return { "svn" : self.__svn, "size" : self.__size, "dgst" : bytes(self.__sha384_dgst) }
+
+    def body_entries(self) -> list:
+        return self.__prebuilt
+
+    def print_preamble(self):
+        print("--------------")
+        print("PREAMBLE")
+        print("--------------")
+        print("MAGIC                    : {}".format(hex(self.magic)))
+        print("VERSION                  : {}".format(hex(self.version)))
+        print("ECC_KEY_INDEX            : {}".format(hex(self.__ecc_key_index)))
+        print("LMS_KEY_INDEX            : {}".format(hex(self.__lms_key_index)))
+        print("ECC_SIGNATURE (32 MSByte): {}".format(self.__ecc_signature.hex()[: 64]))
+        print("LMS_SIGNATURE (32 MSByte): {}".format(self.__lms_signature.hex()[: 64]))
+
+    def print_body(self):
+        print("--------------")
+        print("BODY")
+        print("--------------")
+        print("FMC SIZE                 : {}".format(hex(self.__size)))
+        print("FMC SVN                  : {}".format(hex(self.__svn)))
+        print("FMC DIGEST               : {}".format(self.__sha384_dgst.hex()))
 
         ofst = HDR_SIZE + self.__size
         for pb in self.__prebuilt:
-            # (type, size, dgst)
-            tmp += struct.pack("<2L", pb[0], pb[1])
-            tmp += pb[2]
-
-            if verbose:
-                print("Prebuilt Type            : {}".format(hex(pb[0])))
-                print("Prebuilt Offset          : {}".format(hex(ofst)))
-                print("Prebuilt Size            : {}".format(hex(pb[1])))
-                print("Prebuilt Digest          : {}".format(pb[2].hex()))
+            print("Prebuilt Type            : {}".format(hex(pb[0])))
+            print("Prebuilt Offset          : {}".format(hex(ofst)))
+            print("Prebuilt Size            : {}".format(hex(pb[1])))
+            print("Prebuilt Digest          : {}".format(pb[2].hex()))
 
             ofst += pb[1]
-
-        tmp_len = len(tmp)
-        if tmp_len > HDR_BODY_SIZE:
-            raise RuntimeError("invalid body size={}, expected <= {}".format(tmp_len, HDR_BODY_SIZE))
-
-        body[: tmp_len] = tmp
-
-        return body
-
-    def output(self, verbose : bool = False):
-        preamble = self.output_preamble(verbose)
-        body = self.output_body(verbose)
-
-        return preamble + body
@@ -0,0 +1,150 @@
+# Copyright (c) 2024 ASPEED Technology Inc.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import hashlib
+import os
+import tempfile
+from os import path
+
+CHUNK_SIZE = 0x100000           # 1MB
+
+# process umask, mkstemp() always creates files with mode 0600
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+def sha384_file(f, pad: int = 0) -> bytes:
+    # hash from the current position to EOF with a bounded buffer, then
+    # account for the zero padding appended to the image
+    h = hashlib.sha384()
+    buf = bytearray(CHUNK_SIZE)
+    view = memoryview(buf)
+
+    while True:
+        n = f.readinto(buf)
+        if not n:
+            break
+        h.update(view[: n])
+
+    if pad > 0:
+        h.update(bytes(pad))
+
+    return h.digest()
+
+def copy_fd(src_fd: int, dst_fd: int, size: int):
+    # copy from the current position of src_fd to the current position of
+    # dst_fd, preferring in-kernel copies over a userspace bounce buffer
+    left = size
+
+    if hasattr(os, "copy_file_range"):
+        try:
+            while left > 0:
+                n = os.copy_file_range(src_fd, dst_fd, left)
+                if n == 0:
+                    break
+                left -= n
+        except OSError:
+            pass
+
+    if left > 0 and hasattr(os, "sendfile"):
+        try:
+            while left > 0:
+                n = os.sendfile(dst_fd, src_fd, None, left)
+                if n == 0:
+                    break
+                left -= n
+        except OSError:
+            pass
+
+    while left > 0:
+        chunk = os.read(src_fd, min(left, CHUNK_SIZE))
+        if len(chunk) == 0:
+            break
+        write_fd(dst_fd, chunk)
+        left -= len(chunk)
+
+    if left > 0:
+        raise RuntimeError("short copy, {} bytes missing".format(left))
+
+def write_fd(fd: int, buf):
+    view = memoryview(buf)
+
+    while len(view) > 0:
+        n = os.write(fd, view)
+        view = view[n :]
+
+class AtomicFile:
+    # the output is assembled in a temporary file next to the destination and
+    # renamed over it on commit, readers never observe a partial image
+    # mode defaults to what open() would create, sync makes the file durable
+    # before it replaces the destination
+    def __init__(self, out_path, mode=None, sync=False):
+        self.path = out_path
+        self.sync = sync
+        out_dir = path.dirname(path.abspath(out_path))
+
+        self.fd, self.tmp = tempfile.mkstemp(dir=out_dir, prefix=".{}.".format(path.basename(out_path)))
+        os.fchmod(self.fd, mode if mode is not None else 0o666 & ~_UMASK)
+
+    def write(self, buf):
+        write_fd(self.fd, buf)
+
+    def write_zeros(self, size: int):
+        if size > 0:
+            write_fd(self.fd, bytes(size))
+
+    def copy_from(self, src_path, size: int, st=None):
+        src_fd = os.open(src_path, os.O_RDONLY)
+
+        try:
+            # the source must still be the file which was hashed
+            if st is not None:
+                cur = os.fstat(src_fd)
+                if (cur.st_size, cur.st_mtime_ns) != (st.st_size, st.st_mtime_ns):
+                    raise RuntimeError("{} changed while generating the image".format(src_path))
+
+            copy_fd(src_fd, self.fd, size)
+        finally:
+            os.close(src_fd)
+
+    def commit(self):
+        if self.sync:
+            os.fsync(self.fd)
+        os.close(self.fd)
+        self.fd = -1
+        os.replace(self.tmp, self.path)
+
+    def abort(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+        if path.exists(self.tmp):
+            os.unlink(self.tmp)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
+
+        return False
@@ -0,0 +1,199 @@
+# Copyright (c) 2024 ASPEED Technology Inc.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import hashlib
+import os
+from os import path
+from hdr_parse import MappedImage
+from hdr_parse import parse_image
+from image_io import copy_fd
+from image_io import write_fd
+import hdr_v2
+
+UPDATE_UNCHANGED = "unchanged"
+UPDATE_PATCHED = "patched"
+UPDATE_REWRITTEN = "rewritten"
+
+class Section:
+    pass
+
+def image_sections(fmc_info, pbs_info, hdr_size) -> list:
+    # (path, offset, size, pad, stat, dgst) of each section behind the header
+    sections = []
+
+    s = Section()
+    s.path = fmc_info.path
+    s.offset = hdr_size
+    s.size = fmc_info.size
+    s.pad = fmc_info.pad
+    s.stat = fmc_info.stat
+    s.dgst = fmc_info.dgst
+    sections.append(s)
+
+    ofst = hdr_size + fmc_info.size
+    for pbi in pbs_info:
+        s = Section()
+        s.path = pbi.path
+        s.offset = ofst
+        s.size = pbi.size
+        s.pad = 0
+        s.stat = pbi.stat
+        s.dgst = pbi.dgst
+        sections.append(s)
+        ofst += pbi.size
+
+    return sections
+
+def signatures_current(info, body, ecc_key, ecc_key_idx, lms_key, lms_key_idx) -> bool:
+    # the existing signatures are kept only if they are exactly what this
+    # build would produce: same key indexes and valid under the given keys
+    from verify import verify_ecc
+    from verify import verify_lms
+
+    if ecc_key is None:
+        if any(info.ecc_signature) or info.ecc_key_index != 0:
+            return False
+    else:
+        if info.ecc_key_index != ecc_key_idx or not any(info.ecc_signature):
+            return False
+
+        from main import load_ecc_key
+        key = load_ecc_key(ecc_key) if isinstance(ecc_key, str) else ecc_key
+        if not verify_ecc(key.public_key(), body, info.ecc_signature):
+            return False
+
+    if lms_key is None:
+        if any(info.lms_signature) or info.lms_key_index != 0:
+            return False
+    else:
+        if info.lms_key_index != lms_key_idx or not any(info.lms_signature):
+            return False
+
+        from key_index import lms_pub_path
+        from pyhsslms import HssPublicKey
+        try:
+            pub_path = lms_pub_path(lms_key)
+        except RuntimeError:
+            return False
+
+        f = open(pub_path, "rb")
+        pub = HssPublicKey.deserialize(f.read())
+        f.close()
+
+        try:
+            if not verify_lms(pub, body, info.lms_signature):
+                return False
+        except (RuntimeError, ValueError):
+            return False
+
+    return True
+
+def existing_digests(m, info, version) -> list:
+    # v2 records every digest in the header, v1 sections are re-hashed
+    if version == 2:
+        return [info.fmc_dgst] + [pb.dgst for pb in info.prebuilts]
+
+    regions = [(info.fmc_offset, info.fmc_size)] + [(pb.offset, pb.size) for pb in info.prebuilts]
+    dgsts = []
+    for ofst, size in regions:
+        data = m.view[ofst : ofst + size]
+        dgsts.append(hashlib.sha384(data).digest())
+        data.release()
+
+    return dgsts
+
+def update_image(out_path, version, fmc_info, pbs_info, gen_hdr,
+                 ecc_key=None, ecc_key_idx=0, lms_key=None, lms_key_idx=0, verbose=False) -> str:
+    # gen_hdr(sign) generates the header of the new image, signed or not;
+    # returns how the existing output was brought up to date
+    from main import write_image
+
+    diff = None
+    if path.isfile(out_path):
+        try:
+            diff = compare_image(out_path, version, fmc_info, pbs_info, gen_hdr(False),
+                                 ecc_key, ecc_key_idx, lms_key, lms_key_idx)
+        except (OSError, RuntimeError, ValueError):
+            diff = None
+
+    # layout shifted or no usable output, regenerate everything
+    if diff is None:
+        write_image(out_path, gen_hdr(True), fmc_info, pbs_info, verbose)
+        return UPDATE_REWRITTEN
+
+    hdr_changed, changed = diff
+    if not hdr_changed and len(changed) == 0:
+        return UPDATE_UNCHANGED
+
+    # same layout, rewrite the header and the changed sections in place
+    hdr = gen_hdr(True).output(verbose)
+    fd = os.open(out_path, os.O_WRONLY)
+
+    try:
+        for s in changed:
+            src_fd = os.open(s.path, os.O_RDONLY)
+            try:
+                cur = os.fstat(src_fd)
+                if (cur.st_size, cur.st_mtime_ns) != (s.stat.st_size, s.stat.st_mtime_ns):
+                    raise RuntimeError("{} changed while generating the image".format(s.path))
+
+                os.lseek(fd, s.offset, os.SEEK_SET)
+                copy_fd(src_fd, fd, s.size - s.pad)
+                if s.pad > 0:
+                    write_fd(fd, bytes(s.pad))
+            finally:
+                os.close(src_fd)
+
+        os.lseek(fd, 0, os.SEEK_SET)
+        write_fd(fd, hdr)
+    finally:
+        os.close(fd)
+
+    return UPDATE_PATCHED
+
+def compare_image(out_path, version, fmc_info, pbs_info, unsigned,
+                  ecc_key=None, ecc_key_idx=0, lms_key=None, lms_key_idx=0):
+    # returns None if the layout differs, else (header changed, changed sections)
+    hdr_size = len(unsigned.output())
+    sections = image_sections(fmc_info, pbs_info, hdr_size)
+
+    with MappedImage(out_path) as m:
+        info = parse_image(m.view)
+
+        if info.version != version:
+            return None
+
+        # any size change moves every following section
+        old_layout = [info.fmc_size] + [(pb.type, pb.size) for pb in info.prebuilts]
+        new_layout = [fmc_info.size] + [(pbi.type, pbi.size) for pbi in pbs_info]
+        if old_layout != new_layout or info.image_size != sections[-1].offset + sections[-1].size:
+            return None
+
+        dgsts = existing_digests(m, info, version)
+        changed = [s for s, d in zip(sections, dgsts) if s.dgst != d]
+
+        if version == 1:
+            hdr_changed = bytes(m.view[: hdr_size]) != unsigned.output()
+        else:
+            body = bytes(m.view[hdr_v2.HDR_PREAMBLE_SIZE : hdr_v2.HDR_SIZE])
+            hdr_changed = (body != unsigned.output_body() or
+                           not signatures_current(info, body, ecc_key, ecc_key_idx, lms_key, lms_key_idx))
+
+    return (hdr_changed, changed)
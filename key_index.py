@@ -0,0 +1,278 @@
+# Copyright (c) 2024 ASPEED Technology Inc.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import argparse
+import hashlib
+import json
+import os
+from os import path
+from digest_cache import default_cache_dir
+from image_io import AtomicFile
+
+KEY_INDEX_VERSION = 1
+KEY_SLOTS = 16                  # hdr_v2.HDR_MAX_KEYID, 16-bits bitmap in OTP
+KEY_HASH_LEN = 48               # SHA384 entries of an OTP key hash table
+
+ECC_PUB_PATTERN = "test_oem_dss_public_key_ecdsa384_{}.pem"
+LMS_PUB_PATTERN = "test_oem_dss_lms_key_{}.pub"
+
+def default_key_index_dir():
+    return path.join(path.dirname(default_cache_dir()), "keys")
+
+def _ecc_pub(key):
+    # path of a private key, or a loaded private or public key
+    if isinstance(key, str):
+        from main import load_ecc_key
+        key = load_ecc_key(key)
+
+    return key.public_key() if hasattr(key, "public_key") else key
+
+def ecc_key_fingerprint(key) -> str:
+    # SHA256 of the DER public key, the same key in any PEM encoding matches
+    from cryptography.hazmat.primitives.serialization import Encoding
+    from cryptography.hazmat.primitives.serialization import PublicFormat
+
+    return hashlib.sha256(_ecc_pub(key).public_bytes(Encoding.DER, PublicFormat.SubjectPublicKeyInfo)).hexdigest()
+
+def lms_pub_path(key) -> str:
+    # .pub next to a .prv path, LmsSigner, LmsReservation or pyhsslms key
+    if isinstance(key, str):
+        return path.splitext(key)[0] + ".pub"
+    if hasattr(key, "signer"):
+        key = key.signer
+    if hasattr(key, "pub_path"):
+        return key.pub_path
+    if hasattr(key, "pub_filename"):
+        return key.pub_filename
+
+    raise RuntimeError("cannot find the public key of LMS key {}".format(type(key).__name__))
+
+def lms_key_fingerprint(key) -> str:
+    # SHA256 of the HSS public key, the private key is not loaded
+    f = open(lms_pub_path(key), "rb")
+    pub = f.read()
+    f.close()
+
+    return hashlib.sha256(pub).hexdigest()
+
+def ecc_key_hash(key) -> bytes:
+    # OTP hash table entry: SHA384 of the big-endian x || y
+    from cryptography.hazmat.primitives.serialization import Encoding
+    from cryptography.hazmat.primitives.serialization import PublicFormat
+
+    return hashlib.sha384(_ecc_pub(key).public_bytes(Encoding.X962, PublicFormat.UncompressedPoint)[1 :]).digest()
+
+def lms_key_hash(pub_path) -> bytes:
+    # OTP hash table entry: SHA384 of the LMS public key, without the HSS levels
+    f = open(pub_path, "rb")
+    pub = f.read()
+    f.close()
+
+    return hashlib.sha384(pub[4 :]).digest()
+
+def load_key_hash_table(table_path) -> list:
+    # one SHA384 per slot, slot 0 first
+    f = open(table_path, "rb")
+    buf = f.read()
+    f.close()
+
+    if len(buf) == 0 or len(buf) % KEY_HASH_LEN != 0 or len(buf) // KEY_HASH_LEN > KEY_SLOTS:
+        raise RuntimeError("invalid key hash table {} size={}, expected 1 ~ {} SHA384 digests".format(
+                           table_path, len(buf), KEY_SLOTS))
+
+    return [buf[i : i + KEY_HASH_LEN] for i in range(0, len(buf), KEY_HASH_LEN)]
+
+# fingerprint -> OTP slot of every public key of a key directory, where slot i
+# holds the keys named by the patterns for i; the index is cached and only
+# rebuilt when one of those files is added, removed or modified
+class KeyIndex:
+    def __init__(self, key_dir, cache_dir=None, ecc_pattern=ECC_PUB_PATTERN,
+                 lms_pattern=LMS_PUB_PATTERN, rebuild=False):
+        self.key_dir = path.abspath(key_dir)
+        self.ecc_pattern = ecc_pattern
+        self.lms_pattern = lms_pattern
+
+        if not path.isdir(self.key_dir):
+            raise RuntimeError("cannot find key directory {}".format(key_dir))
+
+        cache_dir = cache_dir if cache_dir is not None else default_key_index_dir()
+        name = hashlib.sha256(json.dumps([self.key_dir, ecc_pattern, lms_pattern]).encode()).hexdigest()
+        self.index_path = path.join(cache_dir, name[: 32] + ".json")
+
+        self.rebuilt = False
+        sig = self.__dir_signature()
+        doc = None if rebuild else self.__load(sig)
+        if doc is None:
+            doc = self.__build(sig)
+            self.__save(cache_dir, doc)
+            self.rebuilt = True
+
+        self.slots = doc["slots"]
+        self.ecc = { s["ecc"]["fingerprint"] : s["slot"] for s in self.slots if s["ecc"] is not None }
+        self.lms = { s["lms"]["fingerprint"] : s["slot"] for s in self.slots if s["lms"] is not None }
+
+    def __slot_paths(self, i):
+        return (path.join(self.key_dir, self.ecc_pattern.format(i)),
+                path.join(self.key_dir, self.lms_pattern.format(i)))
+
+    def __dir_signature(self) -> str:
+        # stat of every slot file, present or not
+        sts = []
+        for i in range(KEY_SLOTS):
+            for p in self.__slot_paths(i):
+                try:
+                    st = os.stat(p)
+                    sts.append([st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns])
+                except OSError:
+                    sts.append(None)
+
+        return hashlib.sha256(json.dumps(sts).encode()).hexdigest()
+
+    def __load(self, sig):
+        try:
+            f = open(self.index_path, "r")
+            doc = json.load(f)
+            f.close()
+        except (OSError, ValueError):
+            return None
+
+        if (doc.get("version") != KEY_INDEX_VERSION or doc.get("key_dir") != self.key_dir or
+            doc.get("signature") != sig):
+            return None
+
+        return doc
+
+    def __build(self, sig) -> dict:
+        from cryptography.hazmat.primitives.serialization import load_pem_public_key
+
+        slots = []
+        seen = {}
+        for i in range(KEY_SLOTS):
+            ecc_path, lms_path = self.__slot_paths(i)
+            slot = { "slot" : i, "ecc" : None, "lms" : None }
+
+            if path.isfile(ecc_path):
+                f = open(ecc_path, "rb")
+                pub = load_pem_public_key(f.read())
+                f.close()
+                slot["ecc"] = { "file" : path.basename(ecc_path), "fingerprint" : ecc_key_fingerprint(pub),
+                                "hash" : ecc_key_hash(pub).hex() }
+
+            if path.isfile(lms_path):
+                slot["lms"] = { "file" : path.basename(lms_path), "fingerprint" : lms_key_fingerprint(lms_path),
+                                "hash" : lms_key_hash(lms_path).hex() }
+
+            # one key in two slots would make the index ambiguous
+            for kind in ("ecc", "lms"):
+                if slot[kind] is not None:
+                    other = seen.setdefault((kind, slot[kind]["fingerprint"]), i)
+                    if other != i:
+                        raise RuntimeError("{} key of slot {} is also in slot {} of {}".format(kind.upper(), i, other, self.key_dir))
+
+            slots.append(slot)
+
+        return { "version" : KEY_INDEX_VERSION, "key_dir" : self.key_dir, "signature" : sig, "slots" : slots }
+
+    def __save(self, cache_dir, doc):
+        # the index is only an accelerator, a read-only cache is fine
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            with AtomicFile(self.index_path) as f:
+                f.write(json.dumps(doc, indent=1).encode())
+        except OSError:
+            pass
+
+    def ecc_slot(self, key) -> int:
+        slot = self.ecc.get(ecc_key_fingerprint(key))
+        if slot is None:
+            raise RuntimeError("ECDSA384 signing key is not in the key index of {}".format(self.key_dir))
+
+        return slot
+
+    def lms_slot(self, key) -> int:
+        slot = self.lms.get(lms_key_fingerprint(key))
+        if slot is None:
+            raise RuntimeError("LMS key {} is not in the key index of {}".format(lms_pub_path(key), self.key_dir))
+
+        return slot
+
+    def resolve(self, ecc_key, ecc_key_idx, lms_key, lms_key_idx):
+        # a missing index is looked up, a given one must match the key's slot
+        if ecc_key is not None:
+            slot = self.ecc_slot(ecc_key)
+            if ecc_key_idx is not None and ecc_key_idx != slot:
+                raise RuntimeError("ECDSA384 key is in OTP slot {} of {}, not key index {}".format(slot, self.key_dir, ecc_key_idx))
+            ecc_key_idx = slot
+
+        if lms_key is not None:
+            slot = self.lms_slot(lms_key)
+            if lms_key_idx is not None and lms_key_idx != slot:
+                raise RuntimeError("LMS key is in OTP slot {} of {}, not key index {}".format(slot, self.key_dir, lms_key_idx))
+            lms_key_idx = slot
+
+        return ecc_key_idx, lms_key_idx
+
+    def check_table(self, kind, table) -> list:
+        # slots whose key does not hash to the table entry of the slot
+        reasons = []
+        for i, dgst in enumerate(table):
+            key = self.slots[i][kind]
+            if key is None:
+                reasons.append("no {} key for slot {}".format(kind.upper(), i))
+            elif bytes.fromhex(key["hash"]) != dgst:
+                reasons.append("{} key {} does not match slot {} of the hash table".format(kind.upper(), key["file"], i))
+
+        return reasons
+
+def cmd_keys(argv) -> int:
+    parser = argparse.ArgumentParser(prog="fmc-imgtool keys", description="manage signing key directories")
+    sub = parser.add_subparsers(dest="action", required=True)
+    p = sub.add_parser("index", help="index the public keys of a directory by fingerprint and OTP slot")
+    p.add_argument("key_dir", metavar="DIR", help="key directory")
+    p.add_argument("--ecc-pattern", metavar="FMT", help="ECDSA384 public key file name, Default={}".format(ECC_PUB_PATTERN), default=ECC_PUB_PATTERN)
+    p.add_argument("--lms-pattern", metavar="FMT", help="LMS public key file name, Default={}".format(LMS_PUB_PATTERN), default=LMS_PUB_PATTERN)
+    p.add_argument("--ecc-table", metavar="FILE", help="OTP hash table of the ECDSA384 keys, one SHA384 per slot")
+    p.add_argument("--lms-table", metavar="FILE", help="OTP hash table of the LMS keys, one SHA384 per slot")
+    p.add_argument("--cache-dir", metavar="DIR", help="key index directory, Default=~/.cache/fmc_imgtool/keys")
+    p.add_argument("--rebuild", help="rebuild the index even if the directory did not change", action="store_true", default=False)
+    p.add_argument("--json", help="print JSON instead of text", action="store_true", default=False)
+    args = parser.parse_args(argv)
+
+    index = KeyIndex(args.key_dir, args.cache_dir, args.ecc_pattern, args.lms_pattern, args.rebuild)
+
+    reasons = []
+    if args.ecc_table is not None:
+        reasons += index.check_table("ecc", load_key_hash_table(args.ecc_table))
+    if args.lms_table is not None:
+        reasons += index.check_table("lms", load_key_hash_table(args.lms_table))
+
+    if args.json:
+        print(json.dumps({ "index" : index.index_path, "rebuilt" : index.rebuilt,
+                           "slots" : index.slots, "errors" : reasons }, indent=2))
+    else:
+        print("{}: {} ({})".format(index.key_dir, index.index_path, "rebuilt" if index.rebuilt else "up to date"))
+        for s in index.slots:
+            print("  slot {:2}  ecc {}  lms {}".format(s["slot"],
+                  s["ecc"]["fingerprint"][: 16] if s["ecc"] is not None else "-" * 16,
+                  s["lms"]["fingerprint"][: 16] if s["lms"] is not None else "-" * 16))
+        for r in reasons:
+            print("FAILED {}".format(r))
+
+    return 0 if len(reasons) == 0 else 1
@@ -0,0 +1,601 @@
+# Copyright (c) 2024 ASPEED Technology Inc.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import argparse
+import fcntl
+import hashlib
+import json
+import os
+import socket
+import struct
+import threading
+import time
+from os import path
+from image_io import AtomicFile
+from pyhsslms import LmotsPrivateKey
+from pyhsslms import LmsPublicKey
+from pyhsslms.pyhsslms import lmots_params
+from pyhsslms.pyhsslms import lms_params
+from pyhsslms.pyhsslms import D_INTR, D_LEAF, D_PBLC, D_PRG
+
+LMS_LEN_I = 16
+LMS_PRV_V2_TAG = b'\x11\x11\x11\x11'    # pyhsslms multi-level private key format
+
+LMS_TREE_MAGIC = b'LMST'
+LMS_TREE_VERSION = 1
+LMS_TREE_HDR = struct.Struct(">4sL4s4s16s32s")  # magic, version, lms, lmots, I, seed tag
+LMS_TREE_CSUM_LEN = 32                          # SHA256 over header and nodes
+
+LMS_STATE_VERSION = 1
+
+LMS_KEYGEN_CHUNK = 512                          # leaves per keygen task
+LMS_PRV_PATTERN = "test_oem_dss_lms_key_{}.prv"
+
+def _hash_fn(alg, n):
+    if alg == "sha256":
+        return lambda buf: hashlib.sha256(buf).digest()[: n]
+    if alg == "shake256":
+        return lambda buf: hashlib.shake_256(buf).digest(n)
+
+    raise RuntimeError("unsupported LMS hash algorithm {}".format(alg))
+
+def lms_key_levels(prv_path) -> int:
+    f = open(prv_path, "rb")
+    levels = f.read(4)
+    f.close()
+
+    if len(levels) != 4:
+        raise RuntimeError("invalid LMS private key {}".format(prv_path))
+
+    return int.from_bytes(levels, "big")
+
+def lms_leaf_nodes(lms_type, lmots_type, I, seed, start, end) -> bytes:
+    # Merkle leaves T[2^h + q] for q in [start, end), each one is the hash of
+    # a full LM-OTS public key derivation, which dominates key loading
+    alg, n, p, w, ls = lmots_params[lmots_type]
+    alg2, m, h = lms_params[lms_type]
+    hash_n = _hash_fn(alg, n)
+    hash_m = _hash_fn(alg2, m)
+    chain = (1 << w) - 1
+    leaves = bytearray()
+
+    for q in range(start, end):
+        Iq = I + q.to_bytes(4, "big")
+
+        if alg == "sha256":
+            K = hashlib.sha256(Iq + D_PBLC)
+        else:
+            K = hashlib.shake_256(Iq + D_PBLC)
+
+        for i in range(p):
+            pre = Iq + i.to_bytes(2, "big")
+            tmp = hash_n(pre + D_PRG + seed)
+            for j in range(chain):
+                tmp = hash_n(pre + bytes((j,)) + tmp)
+            K.update(tmp)
+
+        K = K.digest()[: n] if alg == "sha256" else K.digest(n)
+        leaves += hash_m(I + ((1 << h) + q).to_bytes(4, "big") + D_LEAF + K)
+
+    return bytes(leaves)
+
+def lms_tree_nodes(lms_type, I, leaves) -> bytearray:
+    # nodes are stored by their RFC 8554 index r, index 0 is unused
+    alg2, m, h = lms_params[lms_type]
+    hash_m = _hash_fn(alg2, m)
+    nodes = bytearray(m << h) + leaves
+
+    if len(nodes) != m << (h + 1):
+        raise RuntimeError("invalid number of LMS leaves={}".format(len(leaves) // m))
+
+    for r in range((1 << h) - 1, 0, -1):
+        nodes[r * m : (r + 1) * m] = hash_m(I + r.to_bytes(4, "big") + D_INTR +
+                                            nodes[2 * r * m : (2 * r + 2) * m])
+
+    return nodes
+
+class LmsSigner:
+    # single level HSS/LMS signer with the Merkle tree cached next to the key,
+    # a signature costs one LM-OTS signature plus reading the auth path
+    def __init__(self, prv_path, leaves_fn=None):
+        # every path to the key shares one lock, state and tree; a symlinked
+        # key is advanced where it lives
+        self.key_name = path.splitext(path.realpath(path.splitext(prv_path)[0] + ".prv"))[0]
+        self.prv_path = self.key_name + ".prv"
+        self.pub_path = self.key_name + ".pub"
+        self.tree_path = self.key_name + ".tree"
+        self.state_path = self.key_name + ".state"
+        self.lock_path = self.key_name + ".lock"
+
+        self.__load_prv()
+        self.__load_pub()
+
+        self.nodes = self.__load_tree()
+        if self.nodes is None:
+            self.nodes = self.build_tree(leaves_fn)
+
+    def __load_prv(self):
+        f = open(self.prv_path, "rb")
+        buf = f.read()
+        f.close()
+
+        if len(buf) < 8 or int.from_bytes(buf[0 : 4], "big") != 1:
+            raise RuntimeError("unsupported LMS private key {}, expected 1 level".format(self.prv_path))
+
+        # pyhsslms v2 format carries the key length, v1 starts right away
+        ofst = 8
+        if buf[4 : 8] == LMS_PRV_V2_TAG:
+            ofst += 4
+
+        self.lms_type = buf[ofst : ofst + 4]
+        self.lmots_type = buf[ofst + 4 : ofst + 8]
+
+        if self.lms_type not in lms_params or self.lmots_type not in lmots_params:
+            raise RuntimeError("invalid LMS private key {}".format(self.prv_path))
+
+        alg, n, p, w, ls = lmots_params[self.lmots_type]
+        alg2, m, h = lms_params[self.lms_type]
+        if alg != alg2:
+            raise RuntimeError("invalid LMS private key {}".format(self.prv_path))
+
+        ofst += 8
+        self.seed = buf[ofst : ofst + n]
+        ofst += n
+        self.I = buf[ofst : ofst + LMS_LEN_I]
+        ofst += LMS_LEN_I
+        self.q = int.from_bytes(buf[ofst : ofst + 4], "big")
+        self.q_ofst = ofst
+
+        if len(self.I) != LMS_LEN_I or ofst + 4 > len(buf):
+            raise RuntimeError("invalid LMS private key {}".format(self.prv_path))
+
+        self.m = m
+        self.h = h
+
+    def __load_pub(self):
+        f = open(self.pub_path, "rb")
+        buf = f.read()
+        f.close()
+
+        if (int.from_bytes(buf[0 : 4], "big") != 1 or
+            buf[4 : 8] != self.lms_type or buf[8 : 12] != self.lmots_type or
+            buf[12 : 12 + LMS_LEN_I] != self.I):
+            raise RuntimeError("LMS public key {} does not match {}".format(self.pub_path, self.prv_path))
+
+        self.K = buf[12 + LMS_LEN_I : 12 + LMS_LEN_I + self.m]
+
+    def __seed_tag(self):
+        # binds the tree to the private key without storing the seed
+        return hashlib.sha256(b'fmc_imgtool lms tree' + self.seed + self.I).digest()
+
+    def __load_tree(self):
+        if not path.isfile(self.tree_path):
+            return None
+
+        f = open(self.tree_path, "rb")
+        buf = f.read()
+        f.close()
+
+        size = LMS_TREE_HDR.size + (self.m << (self.h + 1)) + LMS_TREE_CSUM_LEN
+        if len(buf) != size:
+            return None
+
+        body = memoryview(buf)[: -LMS_TREE_CSUM_LEN]
+        if hashlib.sha256(body).digest() != buf[-LMS_TREE_CSUM_LEN :]:
+            return None
+
+        magic, ver, lms_type, lmots_type, I, tag = LMS_TREE_HDR.unpack_from(buf)
+        if ((magic, ver, lms_type, lmots_type, I, tag) !=
+            (LMS_TREE_MAGIC, LMS_TREE_VERSION, self.lms_type, self.lmots_type, self.I, self.__seed_tag())):
+            return None
+
+        nodes = bytearray(body[LMS_TREE_HDR.size :])
+        if nodes[self.m : 2 * self.m] != self.K:
+            return None
+
+        return nodes
+
+    def build_tree(self, leaves_fn=None):
+        # leaves_fn lets the caller spread the leaf computation over workers
+        if leaves_fn is None:
+            leaves = lms_leaf_nodes(self.lms_type, self.lmots_type, self.I, self.seed, 0, 1 << self.h)
+        else:
+            leaves = leaves_fn(self.lms_type, self.lmots_type, self.I, self.seed, 1 << self.h)
+
+        nodes = lms_tree_nodes(self.lms_type, self.I, leaves)
+        if nodes[self.m : 2 * self.m] != self.K:
+            raise RuntimeError("LMS private key {} does not match its public key".format(self.prv_path))
+
+        self.save_tree(nodes)
+
+        return nodes
+
+    def save_tree(self, nodes):
+        body = LMS_TREE_HDR.pack(LMS_TREE_MAGIC, LMS_TREE_VERSION, self.lms_type,
+                                 self.lmots_type, self.I, self.__seed_tag()) + nodes
+
+        # the tree is only an accelerator, a read-only key directory is fine
+        try:
+            with AtomicFile(self.tree_path) as f:
+                f.write(body + hashlib.sha256(body).digest())
+        except OSError:
+            pass
+
+    def remaining(self):
+        return (1 << self.h) - self.q
+
+    def auth_path(self, q):
+        node = (1 << self.h) + q
+        p = []
+
+        while node > 1:
+            sib = node ^ 1
+            p.append(bytes(self.nodes[sib * self.m : (sib + 1) * self.m]))
+            node >>= 1
+
+        return p
+
+    def sign_leaf(self, q, message) -> bytes:
+        # LMS signature of the leaf q, the caller owns q and its state update
+        if q < 0 or q >= (1 << self.h):
+            raise RuntimeError("LMS private key {} is exhausted".format(self.prv_path))
+
+        ots = LmotsPrivateKey(I=self.I, q=q.to_bytes(4, "big"), SEED=self.seed,
+                              lmots_type=self.lmots_type).sign(message)
+        lms_sig = q.to_bytes(4, "big") + ots + self.lms_type + b''.join(self.auth_path(q))
+
+        # a corrupted cache must never produce a shipped signature
+        pub = LmsPublicKey(self.I, self.K, self.lms_type, self.lmots_type)
+        if not pub.verify(message, lms_sig):
+            raise RuntimeError("LMS tree cache {} is corrupted, remove it and retry".format(self.tree_path))
+
+        return lms_sig
+
+    def sign(self, message) -> bytes:
+        # same layout as HssLmsPrivateKey.sign(): Nspk=0 || LMS signature
+        q = self.take_leaves(1)
+
+        return (0).to_bytes(4, "big") + self.sign_leaf(q, message)
+
+    # Leaf reservation. The .prv file and <key>.state are only updated under
+    # an exclusive flock() on <key>.lock, so processes sharing a key never
+    # hand out the same leaf. The state file records the high watermark, the
+    # ranges handed back unused, and the outstanding leases. A lease is a
+    # range owned by one process which signs from it without touching the
+    # shared files; a lease which is never released is not reissued, a crash
+    # loses its leaves but never reuses one.
+    def __lock(self):
+        fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+
+        return fd
+
+    def __unlock(self, fd):
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+    def __load_state(self) -> dict:
+        state = { "version" : LMS_STATE_VERSION, "next" : 0, "free" : [], "leases" : [], "lost" : 0 }
+
+        if path.isfile(self.state_path):
+            f = open(self.state_path)
+            state.update(json.load(f))
+            f.close()
+
+            if state["version"] != LMS_STATE_VERSION:
+                raise RuntimeError("unsupported LMS state {} version={}".format(self.state_path, state["version"]))
+
+        # the .prv may have been advanced by another signer (pyhsslms)
+        self.__load_prv()
+        state["next"] = max(state["next"], self.q)
+
+        return state
+
+    def __save_state(self, state):
+        # the state is synced first, it also covers leaves the .prv may not
+        # record yet if the .prv write is interrupted
+        with AtomicFile(self.state_path, sync=True) as f:
+            f.write(json.dumps(state, indent=1).encode())
+
+        # only the leaf counter changes, it is written in place like pyhsslms
+        # does, keeping the file, its mode, owner and links
+        if self.q != state["next"]:
+            fd = os.open(self.prv_path, os.O_WRONLY)
+            try:
+                if os.pwrite(fd, state["next"].to_bytes(4, "big"), self.q_ofst) != 4:
+                    raise RuntimeError("short write to LMS private key {}".format(self.prv_path))
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            self.q = state["next"]
+
+    def __alloc(self, state, count):
+        # first fit from the returned ranges, then from the high watermark
+        for i, (start, end) in enumerate(state["free"]):
+            if end - start >= count:
+                if end - start == count:
+                    del state["free"][i]
+                else:
+                    state["free"][i] = [start + count, end]
+                return start
+
+        start = state["next"]
+        if start + count > (1 << self.h):
+            raise RuntimeError("LMS private key {} is exhausted, {} leaves left".format(
+                               self.prv_path, (1 << self.h) - start))
+
+        state["next"] = start + count
+
+        return start
+
+    def take_leaves(self, count) -> int:
+        # first leaf of [q, q + count), consumed on disk before it is used
+        fd = self.__lock()
+        try:
+            state = self.__load_state()
+            q = self.__alloc(state, count)
+            self.__save_state(state)
+        finally:
+            self.__unlock(fd)
+
+        return q
+
+    def reserve(self, count):
+        # lease count contiguous leaves to this process, see LmsReservation
+        if count <= 0:
+            raise RuntimeError("invalid number of LMS leaves={}".format(count))
+
+        fd = self.__lock()
+        try:
+            state = self.__load_state()
+            start = self.__alloc(state, count)
+            lease = {
+                "id"        : os.urandom(8).hex(),
+                "start"     : start,
+                "end"       : start + count,
+                "pid"       : os.getpid(),
+                "host"      : socket.gethostname(),
+                "time"      : int(time.time()),
+            }
+            state["leases"].append(lease)
+            self.__save_state(state)
+        finally:
+            self.__unlock(fd)
+
+        return LmsReservation(self, lease)
+
+    def release(self, lease_id, next_q) -> int:
+        # end a lease, leaves from next_q on were never used and are handed
+        # back; returns their number
+        fd = self.__lock()
+        try:
+            state = self.__load_state()
+            lease = None
+            for l in state["leases"]:
+                if l["id"] == lease_id:
+                    lease = l
+            if lease is None:
+                raise RuntimeError("unknown LMS lease {} in {}".format(lease_id, self.state_path))
+
+            state["leases"].remove(lease)
+            unused = lease["end"] - next_q
+            if unused > 0:
+                state["free"].append([next_q, lease["end"]])
+                state["free"].sort()
+            self.__save_state(state)
+        finally:
+            self.__unlock(fd)
+
+        return max(unused, 0)
+
+    def lease_report(self, reap=False) -> dict:
+        # outstanding leases of processes which no longer run on this host are
+        # orphaned; reap drops them for good, their leaves are never reissued
+        fd = self.__lock()
+        try:
+            state = self.__load_state()
+            host = socket.gethostname()
+            orphans = [l for l in state["leases"] if l["host"] == host and not _pid_alive(l["pid"])]
+
+            if reap and len(orphans) > 0:
+                for l in orphans:
+                    state["leases"].remove(l)
+                    state["lost"] += l["end"] - l["start"]
+                self.__save_state(state)
+                orphans = []
+        finally:
+            self.__unlock(fd)
+
+        report = dict(state)
+        report["key"] = self.prv_path
+        report["total"] = 1 << self.h
+        report["available"] = (1 << self.h) - state["next"] + sum(e - s for s, e in state["free"])
+        report["leases"] = [dict(l, orphaned=(l in orphans)) for l in state["leases"]]
+
+        return report
+
+def _pid_alive(pid) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+
+    return True
+
+class LmsReservation:
+    # leaves [start, end) leased by LmsSigner.reserve(); signing only touches
+    # memory, any thread of the process may sign from the same reservation
+    def __init__(self, signer, lease):
+        self.signer = signer
+        self.lease_id = lease["id"]
+        self.start = lease["start"]
+        self.end = lease["end"]
+        self.next = self.start
+        self.released = False
+        self.__lock = threading.Lock()
+
+    def remaining(self):
+        return self.end - self.next
+
+    def sign(self, message) -> bytes:
+        # the leaf is taken before it is used, a failed signature wastes it
+        with self.__lock:
+            if self.released:
+                raise RuntimeError("LMS lease {} is released".format(self.lease_id))
+            if self.next >= self.end:
+                raise RuntimeError("LMS lease {} [{}, {}) is used up".format(self.lease_id, self.start, self.end))
+            q = self.next
+            self.next += 1
+
+        return (0).to_bytes(4, "big") + self.signer.sign_leaf(q, message)
+
+    def release(self) -> int:
+        # returns the number of leaves handed back unused
+        with self.__lock:
+            if self.released:
+                return 0
+            self.released = True
+            next_q = self.next
+
+        return self.signer.release(self.lease_id, next_q)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+
+        return False
+
+def lms_sig_from_hdr(sig) -> bytes:
+    # undo the FMC header layout of gen_fmc_hdr_v2(): q and the LMS type are
+    # stored little endian, the rest as in the RFC 8554 signature
+    q = struct.unpack_from("<L", sig, 0)[0]
+    lmots_type = bytes(sig[4 : 8])
+    if lmots_type not in lmots_params:
+        raise RuntimeError("invalid LM-OTS type={}".format(lmots_type.hex()))
+
+    alg, n, p, w, ls = lmots_params[lmots_type]
+    ofst = 8 + n * (p + 1)
+    lms_type = struct.unpack_from("<L", sig, ofst)[0].to_bytes(4, "big")
+    if lms_type not in lms_params:
+        raise RuntimeError("invalid LMS type={}".format(lms_type.hex()))
+
+    alg2, m, h = lms_params[lms_type]
+    end = ofst + 4 + m * h
+    if end > len(sig):
+        raise RuntimeError("invalid LMS signature length={}, expected {}".format(len(sig), end))
+
+    return q.to_bytes(4, "big") + bytes(sig[4 : ofst]) + lms_type + bytes(sig[ofst + 4 : end])
+
+def cmd_lms_leases(argv) -> int:
+    parser = argparse.ArgumentParser(prog="fmc-imgtool lms-leases", description="report the leaf reservations of LMS signing keys")
+    parser.add_argument("keys", metavar="KEY", nargs="+", help="LMS signing key (.prv)")
+    parser.add_argument("--reap", help="drop the leases of processes which are gone, their leaves stay unused", action="store_true", default=False)
+    parser.add_argument("--json", help="print JSON instead of text", action="store_true", default=False)
+    args = parser.parse_args(argv)
+
+    reports = [LmsSigner(k).lease_report(args.reap) for k in args.keys]
+
+    if args.json:
+        print(json.dumps(reports if len(reports) > 1 else reports[0], indent=2))
+        return 0
+
+    for r in reports:
+        print("{}: {} of {} leaves available, next {}, {} lost".format(
+              r["key"], r["available"], r["total"], r["next"], r["lost"]))
+        for start, end in r["free"]:
+            print("  unused  [{}, {})".format(start, end))
+        for l in r["leases"]:
+            print("  {} [{}, {}) pid {} on {}{}".format(
+                  "orphaned" if l["orphaned"] else "leased  ", l["start"], l["end"],
+                  l["pid"], l["host"], ", --reap to drop" if l["orphaned"] else ""))
+
+    return 0
+
+def lms_genkeys(key_paths, lms_type, lmots_type, jobs=1, tree=False):
+    # generate single level keys, the leaves of all keys are computed in
+    # LMS_KEYGEN_CHUNK slices by one pool so that every worker stays busy
+    from concurrent.futures import ProcessPoolExecutor
+
+    alg, n, p, w, ls = lmots_params[lmots_type]
+    alg2, m, h = lms_params[lms_type]
+    keys = [(path.splitext(k)[0], os.urandom(n), os.urandom(LMS_LEN_I)) for k in key_paths]
+
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futs = [[pool.submit(lms_leaf_nodes, lms_type, lmots_type, I, seed, q, min(q + LMS_KEYGEN_CHUNK, 1 << h))
+                 for q in range(0, 1 << h, LMS_KEYGEN_CHUNK)] for _, seed, I in keys]
+
+        for (key_name, seed, I), key_futs in zip(keys, futs):
+            leaves = b''.join(fut.result() for fut in key_futs)
+            K = lms_tree_nodes(lms_type, I, leaves)[m : 2 * m]
+
+            # pyhsslms v2 format with q=0, the same files HssLmsPrivateKey.genkey() writes
+            # only the private key is kept from other users
+            prv = lms_type + lmots_type + seed + I + (0).to_bytes(4, "big")
+            with AtomicFile(key_name + ".prv", mode=0o600, sync=True) as f:
+                f.write((1).to_bytes(4, "big") + LMS_PRV_V2_TAG + len(prv).to_bytes(4, "big") + prv)
+            with AtomicFile(key_name + ".pub", sync=True) as f:
+                f.write((1).to_bytes(4, "big") + lms_type + lmots_type + I + K)
+
+            if tree:
+                LmsSigner(key_name + ".prv", lambda *args: leaves)
+
+            print("{}.prv: {} leaves".format(key_name, 1 << h))
+
+def cmd_lms_keygen(argv) -> int:
+    from hdr_v2 import HDR_MAX_KEYID
+    from pyhsslms import lmots_sha256_n24_w4
+    from pyhsslms import lms_sha256_m24_h15
+
+    parser = argparse.ArgumentParser(prog="fmc-imgtool keygen", description="generate LMS N24/H15/W4 signing keys")
+    parser.add_argument("keys", metavar="KEY", nargs="*", help="LMS signing key (.prv) to generate, with its .pub")
+    parser.add_argument("--all", metavar="DIR", help="generate the keys of all {} key indexes in DIR".format(HDR_MAX_KEYID))
+    parser.add_argument("--pattern", metavar="FMT", help="--all key file name, Default={}".format(LMS_PRV_PATTERN), default=LMS_PRV_PATTERN)
+    parser.add_argument("--jobs", metavar="N", type=int, help="number of worker processes, Default=number of CPUs", default=os.cpu_count())
+    parser.add_argument("--tree", help="also write the <key>.tree signing cache", action="store_true", default=False)
+    parser.add_argument("--force", help="replace existing keys", action="store_true", default=False)
+    args = parser.parse_args(argv)
+
+    keys = [path.splitext(k)[0] + ".prv" for k in args.keys]
+    if args.all is not None:
+        keys += [path.join(args.all, args.pattern.format(i)) for i in range(HDR_MAX_KEYID)]
+
+    if len(keys) == 0:
+        parser.error("no key to generate, give KEY or --all")
+
+    if args.jobs < 1:
+        parser.error("invalid number of jobs={}".format(args.jobs))
+
+    for k in keys:
+        key_name = path.splitext(k)[0]
+        if not args.force and (path.exists(key_name + ".prv") or path.exists(key_name + ".pub")):
+            raise RuntimeError("LMS key {} exists, use --force to replace it".format(k))
+
+        # signing state and tree cache of a replaced key must not survive it
+        for ext in (".state", ".tree"):
+            if path.exists(key_name + ext):
+                os.unlink(key_name + ext)
+
+    lms_genkeys(keys, lms_sha256_m24_h15, lmots_sha256_n24_w4, args.jobs, args.tree)
+
+    return 0
@@ -21,88 +21,226 @@
 
 import argparse
 import hashlib
+import importlib
 import os
 import struct
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.asymmetric import ec
-from cryptography.hazmat.primitives.asymmetric.utils import decode_dss_signature
-from cryptography.hazmat.primitives.serialization import load_pem_private_key
+import sys
 from os import listdir
 from os import path
-from hdr_v1 import *
-from hdr_v2 import *
+from digest_cache import DigestCache
+from image_io import AtomicFile
+from image_io import sha384_file
+from metrics import add_hook
+from metrics import remove_hook
+from metrics import span
+from metrics import Timings
 from prebuilt import PrebuiltType
 from prebuilt import PREBUILT_BIN
-from pyhsslms import HssLmsPrivateKey
-from pyhsslms import HssSignature
 from typing import List
 
+# cryptography, pyhsslms, the thread pool and the header module of each
+# version are imported where they are used, an unsigned build never loads
+# the crypto stacks
+
 class FmcInfo:
     pass
 
 class PrebuiltInfo:
     pass
 
-def gen_fmc_info(fmc_path, fmc_svn) -> FmcInfo:
+def gen_fmc_info(fmc_path, fmc_svn, cache=None) -> FmcInfo:
     fmc_info = FmcInfo()
 
     if not path.isfile(fmc_path):
         raise RuntimeError("cannot find FMC binary {}".format(fmc_path))
 
-    f = open(fmc_path, "rb")
+    f = open(fmc_path, "rb", buffering=0)
 
+    fmc_info.path = fmc_path
     fmc_info.svn = fmc_svn
-    fmc_info.data = f.read()
-    fmc_info.size = f.tell()
+    fmc_info.stat = os.fstat(f.fileno())
+    fmc_info.size = fmc_info.stat.st_size
 
     # force alignment due to the broken design
-    padding = b'\x00' * ((4 - (fmc_info.size & 3)) & 3)
-    fmc_info.data += padding
-    fmc_info.size += len(padding)
+    fmc_info.pad = (4 - (fmc_info.size & 3)) & 3
+    fmc_info.size += fmc_info.pad
 
-    fmc_info.dgst = hashlib.sha384(fmc_info.data).digest()
+    with span("fmc_info", path=fmc_path, size=fmc_info.size):
+        if cache is None:
+            fmc_info.dgst = sha384_file(f, fmc_info.pad)
+        else:
+            fmc_info.dgst = cache.file_digest(f, fmc_path, lambda: sha384_file(f, fmc_info.pad), pad=4)
 
     f.close()
 
     return fmc_info
 
-def gen_prebuilt_info(pb_dir, pb_bin) -> List[PrebuiltInfo]:
-    pbs_info = []
+def gen_one_prebuilt_info(pb_dir, pb_name, pb_type, cache=None) -> PrebuiltInfo:
+    pb_path = pb_dir + pb_name;
 
-    for pb_name in pb_bin:
-        pb_path = pb_dir + pb_name;
+    if not path.isfile(pb_path):
+        raise RuntimeError("cannot find prebuilt binary {}".format(pb_path))
 
-        if not path.isfile(pb_path):
-            raise RuntimeError("cannot find prebuilt binary {}".format(pb_path))
+    f = open(pb_path, "rb", buffering=0)
 
-        f = open(pb_path, "rb")
+    pbi = PrebuiltInfo()
+    pbi.name = pb_name
+    pbi.path = pb_path
+    pbi.type = pb_type.value
+    pbi.stat = os.fstat(f.fileno())
+    pbi.size = pbi.stat.st_size
 
-        pbi = PrebuiltInfo()
-        pbi.name = pb_name
-        pbi.type = pb_bin[pb_name].value
-        pbi.data = f.read()
-        pbi.size = f.tell()
+    with span("prebuilt_info", path=pb_path, size=pbi.size):
+        if cache is None:
+            pbi.dgst = sha384_file(f)
+        else:
+            pbi.dgst = cache.file_digest(f, pb_path, lambda: sha384_file(f))
 
-        pbi.dgst = hashlib.sha384(pbi.data).digest()
+    f.close()
 
-        pbs_info.append(pbi)
+    return pbi
 
-        f.close()
+def gen_prebuilt_info(pb_dir, pb_bin, cache=None, jobs=1) -> List[PrebuiltInfo]:
+    if jobs <= 1:
+        return [gen_one_prebuilt_info(pb_dir, n, pb_bin[n], cache) for n in pb_bin]
 
-    return pbs_info
+    from concurrent.futures import ThreadPoolExecutor
 
-def gen_fmc_hdr_v1(fmc_info, pbs_info) -> FmcHdrV1:
-    hdr = FmcHdrV1()
+    # hashlib releases the GIL, overlap reads and digests of all prebuilts,
+    # map() keeps the PREBUILT_BIN order expected by the header
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        return list(pool.map(lambda n: gen_one_prebuilt_info(pb_dir, n, pb_bin[n], cache), pb_bin))
 
-    hdr.set_fmc_size(fmc_info.size)
+def gen_input_info(fmc_path, fmc_svn, pb_dir, pb_bin, cache=None, jobs=1):
+    with span("input"):
+        return _gen_input_info(fmc_path, fmc_svn, pb_dir, pb_bin, cache, jobs)
 
-    for pbi in pbs_info:
-        hdr.add_prebuilt(pbi.type, pbi.size)
+def _gen_input_info(fmc_path, fmc_svn, pb_dir, pb_bin, cache, jobs):
+    if jobs <= 1:
+        return (gen_fmc_info(fmc_path, fmc_svn, cache),
+                gen_prebuilt_info(pb_dir, pb_bin, cache))
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    # the FMC binary is hashed alongside the prebuilts
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        fmc_fut = pool.submit(gen_fmc_info, fmc_path, fmc_svn, cache)
+        pb_futs = [pool.submit(gen_one_prebuilt_info, pb_dir, n, pb_bin[n], cache) for n in pb_bin]
+
+        return (fmc_fut.result(), [fut.result() for fut in pb_futs])
+
+def load_ecc_key(key_path):
+    from cryptography.hazmat.primitives.serialization import load_pem_private_key
+
+    pem_f = open(key_path, "rb")
+    pem_d = pem_f.read()
+    pem_f.close()
+
+    with span("ecc_key_load", path=key_path):
+        return load_pem_private_key(pem_d, password=None)
+
+def load_lms_key(key_path):
+    from lms_sign import LmsSigner
+    from lms_sign import lms_key_levels
+    from pyhsslms import HssLmsPrivateKey
+
+    with span("lms_key_load", path=key_path):
+        # single level keys sign from the Merkle tree cached next to the key
+        if lms_key_levels(os.path.splitext(key_path)[0] + ".prv") == 1:
+            return LmsSigner(key_path)
+
+        return HssLmsPrivateKey(os.path.splitext(key_path)[0])
+
+def gen_fmc_hdr_v1(fmc_info, pbs_info) -> "FmcHdrV1":
+    from hdr_v1 import FmcHdrV1
+
+    with span("header", version=1):
+        hdr = FmcHdrV1()
+
+        hdr.set_fmc_size(fmc_info.size)
+
+        for pbi in pbs_info:
+            hdr.add_prebuilt(pbi.type, pbi.size)
 
     return hdr
 
+def ecc_sign_body(ecc_key, body, deterministic=False):
+    # ECDSA384 signature of the header body as (r, s), the key is either a
+    # path or a loaded key; deterministic signatures derive the nonce from
+    # the key and the body (RFC 6979), the same body signs to the same bytes
+    from cryptography.exceptions import UnsupportedAlgorithm
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.hazmat.primitives.asymmetric.utils import decode_dss_signature
+
+    try:
+        algo = ec.ECDSA(hashes.SHA384(), deterministic_signing=True) if deterministic else ec.ECDSA(hashes.SHA384())
+    except TypeError:
+        algo = None
+
+    key = load_ecc_key(ecc_key) if isinstance(ecc_key, str) else ecc_key
+    with span("ecc_sign"):
+        try:
+            if algo is None:
+                raise UnsupportedAlgorithm("deterministic ECDSA")
+            sig = key.sign(body, algo)
+        except UnsupportedAlgorithm:
+            raise RuntimeError("deterministic ECDSA requires cryptography >= 43 with OpenSSL >= 3.2")
+    sig_r, sig_s = decode_dss_signature(sig)
+
+    sig_r = sig_r.to_bytes(48, byteorder='big')
+    sig_s = sig_s.to_bytes(48, byteorder='big')
+
+    return sig_r, sig_s
+
+def lms_sign_body(lms_key, body) -> bytes:
+    # LMS signature (N24/H15/W4) of the header body in the header layout
+    from pyhsslms import HssSignature
+
+    key = load_lms_key(lms_key) if isinstance(lms_key, str) else lms_key
+    with span("lms_sign"):
+        hss_sig_bytes = key.sign(hashlib.sha384(body).digest())
+    hss_sig_level = int.from_bytes(hss_sig_bytes[0 : 4], "big") + 1
+    hss_sig = HssSignature.deserialize(hss_sig_bytes)
+
+    # extract signature parameters
+    sig_q = hss_sig.lms_sig.q
+    sig_ots_type = hss_sig.lms_sig.lmots_sig.type
+    sig_ots_C = hss_sig.lms_sig.lmots_sig.C
+    sig_ots_y = b''.join(hss_sig.lms_sig.lmots_sig.y)
+    sig_tree_type = int.from_bytes(hss_sig.lms_sig.type, "big")
+    sig_tree_path = b''.join(hss_sig.lms_sig.path)
+
+    # assemble signature byte array
+    sig_bytes = b''
+    sig_bytes += struct.pack("<L", sig_q)
+    sig_bytes += sig_ots_type
+    sig_bytes += sig_ots_C
+    sig_bytes += sig_ots_y
+    sig_bytes += struct.pack("<L", sig_tree_type)
+    sig_bytes += sig_tree_path
+
+    return sig_bytes
+
+def resolve_key_indexes(key_index, ecc_key, ecc_key_idx, lms_key, lms_key_idx):
+    # with a KeyIndex a missing index is taken from the key's OTP slot and a
+    # given one is checked against it; without, a missing index is 0
+    if key_index is not None:
+        ecc_key_idx, lms_key_idx = key_index.resolve(ecc_key, ecc_key_idx, lms_key, lms_key_idx)
+
+    return (ecc_key_idx if ecc_key_idx is not None else 0,
+            lms_key_idx if lms_key_idx is not None else 0)
+
 def gen_fmc_hdr_v2(fmc_info, pbs_info,
-                   ecc_key_idx, ecc_key, lms_key_idx, lms_key) -> FmcHdrV2:
+                   ecc_key_idx, ecc_key, lms_key_idx, lms_key, ecc_deterministic=False,
+                   key_index=None) -> "FmcHdrV2":
+    ecc_key_idx, lms_key_idx = resolve_key_indexes(key_index, ecc_key, ecc_key_idx, lms_key, lms_key_idx)
+
+    with span("header", version=2):
+        return _gen_fmc_hdr_v2(fmc_info, pbs_info, ecc_key_idx, ecc_key, lms_key_idx, lms_key, ecc_deterministic)
+
+def _gen_fmc_hdr_v2(fmc_info, pbs_info, ecc_key_idx, ecc_key, lms_key_idx, lms_key, ecc_deterministic) -> "FmcHdrV2":
+    from hdr_v2 import FmcHdrV2
 
     hdr = FmcHdrV2()
 
@@ -115,83 +253,241 @@ def gen_fmc_hdr_v2(fmc_info, pbs_info,
 
     # generate ECDSA384 signature
     if ecc_key is not None:
-        pem_f = open(ecc_key, "rb")
-        pem_d = pem_f.read()
-
-        key = load_pem_private_key(pem_d, password=None)
-        sig = key.sign(hdr.output_body(), ec.ECDSA(hashes.SHA384()))
-        sig_r, sig_s = decode_dss_signature(sig)
-
-        sig_r = sig_r.to_bytes(48, byteorder='big')
-        sig_s = sig_s.to_bytes(48, byteorder='big')
+        sig_r, sig_s = ecc_sign_body(ecc_key, hdr.output_body(), ecc_deterministic)
 
         hdr.set_ecc_key_index(ecc_key_idx)
         hdr.set_ecc_signature(sig_r, sig_s)
 
     # generate LMS_signature (N24/H15/W4)
     if lms_key is not None:
-        key = HssLmsPrivateKey(os.path.splitext(lms_key)[0])
-        hss_sig_bytes = key.sign(hashlib.sha384(hdr.output_body()).digest())
-        hss_sig_level = int.from_bytes(hss_sig_bytes[0 : 4], "big") + 1
-        hss_sig = HssSignature.deserialize(hss_sig_bytes)
-
-        # extract signature parameters
-        sig_q = hss_sig.lms_sig.q
-        sig_ots_type = hss_sig.lms_sig.lmots_sig.type
-        sig_ots_C = hss_sig.lms_sig.lmots_sig.C
-        sig_ots_y = b''.join(hss_sig.lms_sig.lmots_sig.y)
-        sig_tree_type = int.from_bytes(hss_sig.lms_sig.type, "big")
-        sig_tree_path = b''.join(hss_sig.lms_sig.path)
-
-        # assemble signature byte array
-        sig_bytes = b''
-        sig_bytes += struct.pack("<L", sig_q)
-        sig_bytes += sig_ots_type
-        sig_bytes += sig_ots_C
-        sig_bytes += sig_ots_y
-        sig_bytes += struct.pack("<L", sig_tree_type)
-        sig_bytes += sig_tree_path
+        sig_bytes = lms_sign_body(lms_key, hdr.output_body())
 
         hdr.set_lms_key_index(lms_key_idx)
         hdr.set_lms_signature(sig_bytes)
 
     return hdr
 
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--input", metavar="IN", help="input FMC raw binary", required=True)
-    parser.add_argument("--output", metavar="OUT", help="output FMC binary with header", required=True)
-    parser.add_argument("--version", help="FMC header version", required=True, type=int, choices=range(1, 3))
+def write_image(out_path, hdr, fmc_info, pbs_info, verbose=False):
+    # generate final output: Header || FMC Binary || Prebuilt Binaries
+    # the inputs are copied file to file, none of them is loaded in memory
+    with span("write", path=out_path), AtomicFile(out_path) as f:
+        f.write(hdr.output(verbose))
+        f.copy_from(fmc_info.path, fmc_info.size - fmc_info.pad, fmc_info.stat)
+        f.write_zeros(fmc_info.pad)
+        for pbi in pbs_info:
+            f.copy_from(pbi.path, pbi.size, pbi.stat)
+
+# subcommands, each one is "module:function" taking the remaining arguments;
+# without a subcommand the arguments describe an image to build
+SUBCOMMANDS = {
+    "inspect"   : "hdr_parse:cmd_inspect",
+    "extract"   : "hdr_parse:cmd_extract",
+    "verify"    : "verify:cmd_verify",
+    "serve"     : "server:cmd_serve",
+    "lms-leases": "lms_sign:cmd_lms_leases",
+    "keygen"    : "lms_sign:cmd_lms_keygen",
+    "prepare"   : "detached:cmd_prepare",
+    "sign-bundle": "detached:cmd_sign_bundle",
+    "attach"    : "detached:cmd_attach",
+    "diff"      : "delta:cmd_diff",
+    "apply"     : "delta:cmd_apply",
+    "flash"     : "flash:cmd_flash",
+    "keys"      : "key_index:cmd_keys",
+}
+
+def run_subcommand(name, argv) -> int:
+    mod, fn = SUBCOMMANDS[name].split(":")
+
+    return getattr(importlib.import_module(mod), fn)(argv)
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+
+    if len(argv) > 0 and argv[0] in SUBCOMMANDS:
+        rc = run_subcommand(argv[0], argv[1:])
+        if rc:
+            raise SystemExit(rc)
+        return
+
+    parser = argparse.ArgumentParser(epilog="subcommands: {}".format(", ".join(SUBCOMMANDS)))
+    parser.add_argument("--input", metavar="IN", help="input FMC raw binary")
+    parser.add_argument("--output", metavar="OUT", help="output FMC binary with header")
+    parser.add_argument("--version", help="FMC header version", type=int, choices=range(1, 3))
     parser.add_argument("--svn", metavar="SVN", type=int, help="FMC security version number, Default=0", default=0)
     parser.add_argument("--ecc-key", metavar="KEY", help="ECDSA384 signing key (.pem)")
-    parser.add_argument("--ecc-key-index", metavar="IDX", type=int, help="ECDSA384 signing key index hint, Default=0", default=0)
+    parser.add_argument("--ecc-key-index", metavar="IDX", type=int, help="ECDSA384 signing key index hint, Default=0 or the slot found in --key-dir")
     parser.add_argument("--lms-key", metavar="KEY", help="LMS signing key (.prv)")
-    parser.add_argument("--lms-key-index", metavar="IDX", type=int, help="LMS signing key index hint, Default=0", default=0)
+    parser.add_argument("--lms-key-index", metavar="IDX", type=int, help="LMS signing key index hint, Default=0 or the slot found in --key-dir")
+    parser.add_argument("--key-dir", metavar="DIR", help="resolve and check the key indexes against the public keys in DIR, see 'keys index'")
     parser.add_argument("--prebuilt-dir", metavar="DIR", help="prebuilt binaries directory, Default=prebuilt/", default="prebuilt/")
     parser.add_argument("--verbose", help="show detail information", action="store_true", default=False)
-    args = parser.parse_args()
-
-    fmc_info = gen_fmc_info(args.input, args.svn)
-    pbs_info = gen_prebuilt_info(args.prebuilt_dir, PREBUILT_BIN)
-
-    if args.version == 1:
-        hdr = gen_fmc_hdr_v1(fmc_info, pbs_info)
-    elif args.version == 2:
-        hdr = gen_fmc_hdr_v2(fmc_info, pbs_info,
-                             args.ecc_key_index, args.ecc_key,
-                             args.lms_key_index, args.lms_key)
+    parser.add_argument("--incremental", help="only rewrite the sections of --output which changed", action="store_true", default=False)
+    parser.add_argument("--manifest", metavar="FILE", help="build all images listed in a JSON/TOML manifest")
+    parser.add_argument("--jobs", metavar="N", type=int, help="number of parallel input/image workers, Default=1", default=1)
+    parser.add_argument("--report", metavar="FILE", help="write the manifest build summary as JSON")
+    parser.add_argument("--cache-dir", metavar="DIR", help="input digest cache directory, Default=~/.cache/fmc_imgtool/digests")
+    parser.add_argument("--no-cache", help="do not use the input digest cache", action="store_true", default=False)
+    parser.add_argument("--verify-cache", help="recompute every digest and check it against the cache", action="store_true", default=False)
+    parser.add_argument("--server", metavar="SOCK", help="send the build to a running 'serve' instance")
+    parser.add_argument("--timings", metavar="FILE", help="write the duration of each build phase")
+    parser.add_argument("--timings-format", help="--timings file format, Default=json", choices=("json", "prometheus"), default="json")
+    parser.add_argument("--profile", metavar="FILE", help="write a cProfile dump of the build, see pstats")
+    parser.add_argument("--plan", help="print the image layout as JSON and check every size limit, without reading the inputs", action="store_true", default=False)
+    parser.add_argument("--watch", help="rebuild --output whenever --input, a prebuilt or a key changes", action="store_true", default=False)
+    parser.add_argument("--watch-delay", metavar="MS", type=int, help="--watch quiet time before rebuilding, Default=20", default=20)
+    parser.add_argument("--deterministic-ecdsa", help="derive the ECDSA384 nonce from key and header (RFC 6979)", action="store_true", default=False)
+    parser.add_argument("--output-cache", help="reuse previously built images with the same inputs and keys", action="store_true", default=False)
+    parser.add_argument("--output-cache-dir", metavar="DIR", help="output image cache directory, Default=~/.cache/fmc_imgtool/images")
+    parser.add_argument("--output-cache-size", metavar="MB", type=int, help="output image cache size bound, Default=1024", default=1024)
+    args = parser.parse_args(argv)
+
+    timings = None
+    if args.timings is not None:
+        timings = Timings()
+        add_hook(timings)
+
+    prof = None
+    if args.profile is not None:
+        import cProfile
+        prof = cProfile.Profile()
+        prof.enable()
+
+    try:
+        with span("build"):
+            build(args, parser)
+    finally:
+        if prof is not None:
+            prof.disable()
+            prof.dump_stats(args.profile)
+
+        if timings is not None:
+            remove_hook(timings)
+            timings.write(args.timings, args.timings_format)
+
+def build(args, parser):
+    cache = None
+    if not args.no_cache:
+        cache = DigestCache(args.cache_dir, verify=args.verify_cache)
+
+    if args.manifest is not None:
+        if args.watch:
+            parser.error("--watch cannot be combined with --manifest")
+        if args.plan:
+            from batch import load_manifest
+            from plan import plan_spec
+            from plan import print_plan
+            if not print_plan([plan_spec(spec) for spec in load_manifest(args.manifest)]):
+                raise SystemExit(1)
+            return
+        if args.key_dir is not None:
+            parser.error("--key-dir cannot be combined with --manifest, use \"key_dir\" in the manifest")
+        from batch import run_manifest
+        if not run_manifest(args.manifest, args.jobs, args.report, args.verbose, cache):
+            raise SystemExit(1)
+        return
+
+    for opt in ("input", "version") if args.plan else ("input", "output", "version"):
+        if getattr(args, opt) is None:
+            parser.error("the following arguments are required: --{}".format(opt))
+
+    if args.plan:
+        from plan import plan_image
+        from plan import print_plan
+        layout = plan_image(args.version, args.input, args.prebuilt_dir, PREBUILT_BIN, args.svn,
+                            args.ecc_key, args.ecc_key_index, args.lms_key, args.lms_key_index)
+        if not print_plan(layout):
+            raise SystemExit(1)
+        return
+
+    if args.jobs < 1:
+        parser.error("invalid number of jobs={}".format(args.jobs))
+
+    # resolved once, every build path below signs with these indexes
+    key_index = None
+    if args.key_dir is not None:
+        from key_index import KeyIndex
+        key_index = KeyIndex(args.key_dir)
+    if args.version == 2:
+        args.ecc_key_index, args.lms_key_index = resolve_key_indexes(key_index, args.ecc_key, args.ecc_key_index,
+                                                                     args.lms_key, args.lms_key_index)
     else:
-        raise RuntimeError("invalid FMC header version={}".format(args.version))
-
-    # generate final output: Header || FMC Binary || Prebuilt Binaries
-    f = open(args.output, "wb")
-
-    f.write(hdr.output(args.verbose))
-    f.write(fmc_info.data)
-    for pbi in pbs_info:
-        f.write(pbi.data)
+        args.ecc_key_index, args.lms_key_index = resolve_key_indexes(None, None, args.ecc_key_index,
+                                                                     None, args.lms_key_index)
+
+    if args.watch:
+        if args.server is not None or args.incremental or args.output_cache:
+            parser.error("--watch cannot be combined with --server, --incremental or --output-cache")
+        if args.watch_delay < 0:
+            parser.error("invalid watch delay={}".format(args.watch_delay))
+        from watch import watch_build
+        watch_build(args, cache, args.watch_delay / 1000)
+        return
+
+    if args.server is not None:
+        # the server keeps no output cache, a hit could not be honoured, and
+        # it builds with its own workers and metrics
+        for opt in ("incremental", "output_cache", "timings", "profile"):
+            if getattr(args, opt) not in (None, False):
+                parser.error("--server cannot be combined with --{}".format(opt.replace("_", "-")))
+        if args.jobs != 1:
+            parser.error("--server cannot be combined with --jobs, see 'serve --jobs'")
+        from server import request_build
+        res = request_build(args.server, args)
+        if res["status"] != "ok":
+            raise RuntimeError("server build failed: {}".format(res["error"]))
+        if args.verbose:
+            print("{}: {}".format(args.output, res["result"]))
+        return
+
+    fmc_info, pbs_info = gen_input_info(args.input, args.svn,
+                                        args.prebuilt_dir, PREBUILT_BIN,
+                                        cache, args.jobs)
+
+    def gen_hdr(sign=True):
+        if args.version == 1:
+            return gen_fmc_hdr_v1(fmc_info, pbs_info)
+        elif args.version == 2 and sign:
+            return gen_fmc_hdr_v2(fmc_info, pbs_info,
+                                  args.ecc_key_index, args.ecc_key,
+                                  args.lms_key_index, args.lms_key, args.deterministic_ecdsa)
+        elif args.version == 2:
+            return gen_fmc_hdr_v2(fmc_info, pbs_info, 0, None, 0, None)
+        else:
+            raise RuntimeError("invalid FMC header version={}".format(args.version))
+
+    # a hit signs nothing, the cached image already holds the signatures
+    # made for this very header body, no LMS leaf is consumed again
+    out_cache = None
+    hit = False
+    if args.output_cache and not args.incremental:
+        if args.output_cache_size < 1:
+            parser.error("invalid output cache size={}".format(args.output_cache_size))
+        from output_cache import OutputCache
+        out_cache = OutputCache(args.output_cache_dir, args.output_cache_size << 20)
+        out_key = out_cache.key(args.version, fmc_info, pbs_info,
+                                args.ecc_key, args.ecc_key_index,
+                                args.lms_key, args.lms_key_index, args.deterministic_ecdsa)
+        hit = out_cache.get(out_key, args.output)
+        if hit and args.verbose:
+            print("{}: output cache hit {}".format(args.output, out_key))
+
+    if hit:
+        pass
+    elif args.incremental:
+        from incremental import update_image
+        res = update_image(args.output, args.version, fmc_info, pbs_info, gen_hdr,
+                           args.ecc_key, args.ecc_key_index,
+                           args.lms_key, args.lms_key_index, args.verbose)
+        if args.verbose:
+            print("{}: {}".format(args.output, res))
+    else:
+        write_image(args.output, gen_hdr(), fmc_info, pbs_info, args.verbose)
+        if out_cache is not None:
+            out_cache.put(out_key, args.output)
 
-    f.close()
+    if cache is not None and len(cache.mismatches) > 0:
+        raise SystemExit(1)
 
 if __name__ == "__main__":
     main()
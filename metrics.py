@@ -0,0 +1,118 @@
+# Copyright (c) 2024 ASPEED Technology Inc.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import json
+import threading
+import time
+from contextlib import contextmanager
+from image_io import AtomicFile
+
+# Phase timing spans. Callers register hooks, each finished span is reported
+# to every hook as (name, seconds, attrs); without hooks a span only costs
+# the context manager.
+_hooks = []
+_hooks_lock = threading.Lock()
+
+def add_hook(fn):
+    global _hooks
+
+    with _hooks_lock:
+        _hooks = _hooks + [fn]
+
+def remove_hook(fn):
+    global _hooks
+
+    with _hooks_lock:
+        _hooks = [h for h in _hooks if h is not fn]
+
+@contextmanager
+def span(name, **attrs):
+    hooks = _hooks
+    if len(hooks) == 0:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        for h in hooks:
+            h(name, seconds, attrs)
+
+class Timings:
+    # hook accumulating the spans of one or more builds, thread safe; long
+    # running callers set keep_spans=False to only keep the per phase totals
+    def __init__(self, keep_spans=True):
+        self.keep_spans = keep_spans
+        self.spans = []
+        self.__phases = {}
+        self.__lock = threading.Lock()
+
+    def __call__(self, name, seconds, attrs):
+        with self.__lock:
+            p = self.__phases.get(name)
+            if p is None:
+                p = self.__phases[name] = { "count" : 0, "total" : 0.0, "max" : 0.0 }
+            p["count"] += 1
+            p["total"] += seconds
+            p["max"] = max(p["max"], seconds)
+
+            if self.keep_spans:
+                self.spans.append((name, seconds, attrs))
+
+    def summary(self) -> dict:
+        # per phase: number of spans, total and maximum duration
+        with self.__lock:
+            return { name : dict(p) for name, p in self.__phases.items() }
+
+    def to_json(self) -> str:
+        with self.__lock:
+            spans = [{ "name" : n, "seconds" : s, **a } for n, s, a in self.spans]
+
+        return json.dumps({ "phases" : self.summary(), "spans" : spans }, indent=2)
+
+    def to_prometheus(self) -> str:
+        lines = [
+            "# HELP fmc_imgtool_phase_seconds Time spent in each image generation phase.",
+            "# TYPE fmc_imgtool_phase_seconds gauge",
+        ]
+        phases = self.summary()
+        for name, p in phases.items():
+            lines.append('fmc_imgtool_phase_seconds{{phase="{}"}} {:.9f}'.format(name, p["total"]))
+
+        lines.append("# HELP fmc_imgtool_phase_count Number of times each phase ran.")
+        lines.append("# TYPE fmc_imgtool_phase_count gauge")
+        for name, p in phases.items():
+            lines.append('fmc_imgtool_phase_count{{phase="{}"}} {}'.format(name, p["count"]))
+
+        return "\n".join(lines) + "\n"
+
+    def write(self, out_path, fmt="json"):
+        if fmt == "json":
+            data = self.to_json() + "\n"
+        elif fmt == "prometheus":
+            data = self.to_prometheus()
+        else:
+            raise RuntimeError("invalid timings format={}".format(fmt))
+
+        # node_exporter may read the textfile at any time
+        with AtomicFile(out_path) as f:
+            f.write(data.encode())
@@ -0,0 +1,156 @@
+# Copyright (c) 2024 ASPEED Technology Inc.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import hashlib
+import json
+import os
+import tempfile
+from os import path
+from digest_cache import default_cache_dir
+from image_io import AtomicFile
+from image_io import copy_fd
+from image_io import sha384_file
+from key_index import ecc_key_fingerprint
+from key_index import lms_key_fingerprint
+
+OUTPUT_CACHE_MAX_BYTES = 1 << 30        # 1GB of images
+OUTPUT_CACHE_FORMAT = 1                 # bump when the image layout changes
+
+def default_output_cache_dir():
+    return path.join(path.dirname(default_cache_dir()), "images")
+
+# Whole images keyed by everything that goes into them. An entry is the
+# SHA384 of the image followed by the image, it is checked on every hit.
+# A hit signs nothing: LMS leaves are only consumed by the build which
+# populated the entry, and its signature is returned for the very same
+# header body.
+class OutputCache:
+    def __init__(self, cache_dir=None, max_bytes=OUTPUT_CACHE_MAX_BYTES):
+        if max_bytes <= 0:
+            raise RuntimeError("invalid output cache size={}".format(max_bytes))
+
+        self.cache_dir = cache_dir if cache_dir is not None else default_output_cache_dir()
+        self.max_bytes = max_bytes
+
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+        except OSError:
+            pass
+
+    def key(self, version, fmc_info, pbs_info, ecc_key=None, ecc_key_idx=0,
+            lms_key=None, lms_key_idx=0, deterministic=False) -> str:
+        k = {
+            "format"        : OUTPUT_CACHE_FORMAT,
+            "version"       : version,
+            "svn"           : fmc_info.svn,
+            "fmc"           : [fmc_info.size, fmc_info.dgst.hex()],
+            "prebuilts"     : [[pbi.type, pbi.size, pbi.dgst.hex()] for pbi in pbs_info],
+        }
+
+        # v1 headers carry neither signatures nor key indexes
+        if version == 2:
+            k["ecc"] = [ecc_key_fingerprint(ecc_key), ecc_key_idx, deterministic] if ecc_key is not None else None
+            k["lms"] = [lms_key_fingerprint(lms_key), lms_key_idx] if lms_key is not None else None
+
+        return hashlib.sha256(json.dumps(k, sort_keys=True).encode()).hexdigest()
+
+    def get(self, key, out_path) -> bool:
+        # copy the cached image to out_path, False on a miss or a damaged entry
+        entry = path.join(self.cache_dir, key)
+
+        try:
+            f = open(entry, "rb", buffering=0)
+        except OSError:
+            return False
+
+        try:
+            size = os.fstat(f.fileno()).st_size - 48
+            dgst = f.read(48)
+            if size <= 0 or sha384_file(f) != dgst:
+                return False
+
+            with AtomicFile(out_path) as out:
+                os.lseek(f.fileno(), 48, os.SEEK_SET)
+                copy_fd(f.fileno(), out.fd, size)
+        finally:
+            f.close()
+
+        # entry is recently used, keep it away from eviction
+        try:
+            os.utime(entry)
+        except OSError:
+            pass
+
+        return True
+
+    def put(self, key, img_path):
+        # the cache is best effort, a read-only cache only costs a rebuild
+        try:
+            fd, tmp = tempfile.mkstemp(dir=self.cache_dir, prefix=".tmp")
+        except OSError:
+            return
+
+        try:
+            src = open(img_path, "rb", buffering=0)
+            try:
+                dgst = sha384_file(src)
+                size = os.fstat(src.fileno()).st_size
+                os.write(fd, dgst)
+                os.lseek(src.fileno(), 0, os.SEEK_SET)
+                copy_fd(src.fileno(), fd, size)
+            finally:
+                src.close()
+
+            os.close(fd)
+            fd = -1
+            os.replace(tmp, path.join(self.cache_dir, key))
+        except OSError:
+            if fd >= 0:
+                os.close(fd)
+            if path.exists(tmp):
+                os.unlink(tmp)
+            return
+
+        self.trim()
+
+    def trim(self):
+        # evict the least recently used images beyond the size bound
+        entries = []
+        total = 0
+
+        for e in os.scandir(self.cache_dir):
+            if e.name.startswith(".tmp"):
+                continue
+            try:
+                st = e.stat()
+            except OSError:
+                continue
+            entries.append((st.st_mtime_ns, st.st_size, e.path))
+            total += st.st_size
+
+        entries.sort()
+        for _, size, e in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(e)
+            except OSError:
+                pass
+            total -= size
@@ -0,0 +1,114 @@
+# Copyright (c) 2024 ASPEED Technology Inc.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import importlib
+import json
+import os
+from prebuilt import PREBUILT_BIN
+
+def _size(file_path, what, errors):
+    try:
+        return os.stat(file_path).st_size
+    except OSError:
+        errors.append("cannot find {} {}".format(what, file_path))
+        return 0
+
+def plan_image(version, fmc_path, pb_dir, pb_bin=PREBUILT_BIN, svn=0,
+               ecc_key=None, ecc_key_idx=0, lms_key=None, lms_key_idx=0) -> dict:
+    # layout of the image from os.stat() alone, with every limit the header
+    # setters would reject in "errors"; no input is opened
+    if version not in (1, 2):
+        return { "version" : version, "errors" : ["invalid FMC header version={}".format(version)] }
+
+    hdr = importlib.import_module("hdr_v{}".format(version))
+    errors = []
+
+    size = _size(fmc_path, "FMC binary", errors)
+    pad = (4 - (size & 3)) & 3
+    if size + pad > hdr.HDR_MAX_FMCSZ:
+        errors.append("invalid image size={}, maximum {}".format(size + pad, hdr.HDR_MAX_FMCSZ))
+
+    layout = {
+        "version"       : version,
+        "header_size"   : hdr.HDR_SIZE,
+        "fmc"           : { "path" : fmc_path, "offset" : hdr.HDR_SIZE, "size" : size + pad,
+                            "pad" : pad, "max_size" : hdr.HDR_MAX_FMCSZ },
+        "prebuilts"     : [],
+    }
+
+    ofst = hdr.HDR_SIZE + size + pad
+    for name, pb_type in pb_bin.items():
+        pb_size = _size(pb_dir + name, "prebuilt binary", errors)
+        if pb_size > 0xffffffff:
+            errors.append("invalid prebuilt binary size={}".format(pb_size))
+
+        layout["prebuilts"].append({ "name" : name, "type" : pb_type.value, "path" : pb_dir + name,
+                                     "offset" : ofst, "size" : pb_size })
+        ofst += pb_size
+
+    used = hdr.BODY.struct.size + len(pb_bin) * hdr.BODY.entry.size
+    if used > hdr.BODY.size:
+        errors.append("invalid body size={}, expected <= {}".format(used, hdr.BODY.size))
+
+    layout["body"] = {
+        "size"          : hdr.BODY.size,
+        "used"          : used,
+        "free"          : hdr.BODY.size - used,
+        "entries"       : len(pb_bin),
+        "max_entries"   : hdr.BODY.max_entries,
+    }
+    layout["image_size"] = ofst
+
+    # the same bounds as FmcHdrV2.set_fmc_svn() and the key index setters,
+    # an index left to --key-dir is only known once the key is read
+    if version == 2:
+        layout["svn"] = svn
+        if svn < 0 or svn > hdr.HDR_MAX_SVN:
+            errors.append("invalid SVN={}, maximum {}".format(svn, hdr.HDR_MAX_SVN))
+
+        if ecc_key is not None:
+            _size(ecc_key, "ECDSA384 key", errors)
+            if ecc_key_idx is not None and (ecc_key_idx < 0 or ecc_key_idx >= hdr.HDR_MAX_KEYID):
+                errors.append("invalid ECC key index={}, expected 0 ~ {}".format(ecc_key_idx, hdr.HDR_MAX_KEYID - 1))
+
+        if lms_key is not None:
+            _size(os.path.splitext(lms_key)[0] + ".prv", "LMS key", errors)
+            if lms_key_idx is not None and (lms_key_idx < 0 or lms_key_idx > hdr.HDR_MAX_KEYID):
+                errors.append("invalid LMS key index={}".format(lms_key_idx))
+
+    layout["errors"] = errors
+
+    return layout
+
+def plan_spec(spec) -> dict:
+    # layout of a manifest image spec
+    layout = plan_image(spec["version"], spec["input"], spec["prebuilt_dir"], PREBUILT_BIN, spec["svn"],
+                        spec["ecc_key"], spec["ecc_key_index"], spec["lms_key"], spec["lms_key_index"])
+    layout["output"] = spec["output"]
+
+    return layout
+
+def print_plan(plan) -> bool:
+    # plan is one layout, or the list of layouts of a manifest
+    print(json.dumps(plan, indent=2))
+
+    layouts = plan if isinstance(plan, list) else [plan]
+
+    return all(len(l["errors"]) == 0 for l in layouts)
@@ -0,0 +1,232 @@
+# Copyright (c) 2024 ASPEED Technology Inc.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Requests and responses are JSON objects, one per line:
+#
+#   {"op": "ping"}
+#   {"op": "build", "input": ..., "output": ..., "version": 2, ...}
+#   {"op": "sign", "body": "<hex>", "ecc_key": ..., "lms_key": ..., "deterministic_ecdsa": false}
+#   {"op": "metrics"}
+#   {"op": "shutdown"}
+#
+# "build" takes the keys of a manifest image spec, with absolute paths.
+# Responses carry "status" ("ok" or "error") and "error" on failure.
+
+import argparse
+import asyncio
+import json
+import os
+import signal
+import socket
+from concurrent.futures import ThreadPoolExecutor
+from os import path
+from batch import BuildContext
+from batch import build_one
+from batch import make_spec
+from batch import SPEC_DEFAULTS
+from batch import SPEC_PATHS
+from digest_cache import DigestCache
+from metrics import add_hook
+from metrics import remove_hook
+from metrics import Timings
+
+SERVER_LINE_LIMIT = 0x100000    # 1MB per request
+
+def check_abs_paths(req, keys):
+    # the server has no working directory of the client to resolve against
+    for key in keys:
+        if req.get(key) is not None and not path.isabs(req[key]):
+            raise RuntimeError("{} request {} path {} is not absolute".format(req.get("op"), key, req[key]))
+
+class BuildServer:
+    def __init__(self, sock_path, jobs=1, cache=None):
+        self.sock_path = sock_path
+        self.jobs = jobs
+        self.ctx = BuildContext(cache, jobs, share_inputs=False)
+        self.pool = ThreadPoolExecutor(max_workers=jobs)
+        self.timings = Timings(keep_spans=False)
+        self.__stop = None
+
+    def preload(self, ecc_keys, lms_keys):
+        for k in ecc_keys:
+            self.ctx.ecc_key(path.abspath(k))
+        for k in lms_keys:
+            self.ctx.lms_key(path.abspath(k))
+
+    def handle(self, req) -> dict:
+        op = req.get("op")
+
+        if op == "ping":
+            return { "status" : "ok" }
+
+        if op == "build":
+            image = { k : v for k, v in req.items() if k != "op" }
+            # defaults included, a relative prebuilt_dir default is an error
+            check_abs_paths(dict(SPEC_DEFAULTS, **req), SPEC_PATHS)
+            spec = make_spec(image, SPEC_DEFAULTS, "/", "build request")
+            result = build_one(self.ctx, spec)
+            if result["status"] != "ok":
+                return { "status" : "error", "error" : result["reason"], "result" : result }
+            return { "status" : "ok", "result" : result }
+
+        if op == "sign":
+            return self.sign(req)
+
+        if op == "metrics":
+            # phase totals since the server started
+            return { "status" : "ok", "phases" : self.timings.summary() }
+
+        raise RuntimeError("unknown request op={}".format(op))
+
+    def sign(self, req) -> dict:
+        from main import ecc_sign_body
+        from main import lms_sign_body
+
+        check_abs_paths(req, ("ecc_key", "lms_key"))
+
+        body = bytes.fromhex(req["body"])
+        res = { "status" : "ok" }
+
+        if req.get("ecc_key") is not None:
+            sig_r, sig_s = ecc_sign_body(self.ctx.ecc_key(req["ecc_key"]), body,
+                                         req.get("deterministic_ecdsa", False))
+            res["ecc_signature"] = (sig_r + sig_s).hex()
+
+        if req.get("lms_key") is not None:
+            with self.ctx.lms_lock(req["lms_key"]):
+                res["lms_signature"] = lms_sign_body(self.ctx.lms_key(req["lms_key"]), body).hex()
+
+        return res
+
+    async def __client(self, reader, writer):
+        loop = asyncio.get_running_loop()
+
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+
+                req = None
+                try:
+                    req = json.loads(line)
+                    if req.get("op") == "shutdown":
+                        res = { "status" : "ok" }
+                    else:
+                        res = await loop.run_in_executor(self.pool, self.handle, req)
+                except Exception as e:
+                    res = { "status" : "error", "error" : str(e) }
+
+                writer.write(json.dumps(res).encode() + b'\n')
+                await writer.drain()
+
+                if isinstance(req, dict) and req.get("op") == "shutdown":
+                    self.__stop.set()
+                    break
+        except (ConnectionError, ValueError, asyncio.CancelledError):
+            # idle connections are cancelled when the server stops
+            pass
+        finally:
+            writer.close()
+
+    async def run(self):
+        self.__stop = asyncio.Event()
+
+        if path.exists(self.sock_path):
+            os.unlink(self.sock_path)
+
+        # keys are loaded in this process, keep the socket private
+        old_umask = os.umask(0o077)
+        try:
+            srv = await asyncio.start_unix_server(self.__client, self.sock_path, limit=SERVER_LINE_LIMIT)
+        finally:
+            os.umask(old_umask)
+
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self.__stop.set)
+
+        add_hook(self.timings)
+        try:
+            async with srv:
+                await self.__stop.wait()
+        finally:
+            remove_hook(self.timings)
+
+        self.pool.shutdown(wait=True)
+        os.unlink(self.sock_path)
+
+def request(sock_path, req) -> dict:
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    try:
+        s.connect(sock_path)
+        s.sendall(json.dumps(req).encode() + b'\n')
+
+        f = s.makefile("rb")
+        line = f.readline()
+        f.close()
+    finally:
+        s.close()
+
+    if not line:
+        raise RuntimeError("no response from server {}".format(sock_path))
+
+    return json.loads(line)
+
+def request_build(sock_path, args) -> dict:
+    # the server resolves nothing against the client working directory
+    req = {
+        "op"            : "build",
+        "input"         : path.abspath(args.input),
+        "output"        : path.abspath(args.output),
+        "version"       : args.version,
+        "svn"           : args.svn,
+        "ecc_key"       : path.abspath(args.ecc_key) if args.ecc_key is not None else None,
+        "ecc_key_index" : args.ecc_key_index,
+        "lms_key"       : path.abspath(args.lms_key) if args.lms_key is not None else None,
+        "lms_key_index" : args.lms_key_index,
+        "key_dir"       : path.abspath(args.key_dir) if args.key_dir is not None else None,
+        "prebuilt_dir"  : path.abspath(args.prebuilt_dir),
+        "deterministic_ecdsa" : args.deterministic_ecdsa,
+    }
+
+    return request(sock_path, req)
+
+def cmd_serve(argv) -> int:
+    parser = argparse.ArgumentParser(prog="fmc-imgtool serve", description="serve build and sign requests over a Unix socket")
+    parser.add_argument("--socket", metavar="PATH", help="Unix socket to listen on", required=True)
+    parser.add_argument("--ecc-key", metavar="KEY", help="ECDSA384 signing key (.pem) to preload", action="append", default=[])
+    parser.add_argument("--lms-key", metavar="KEY", help="LMS signing key (.prv) to preload", action="append", default=[])
+    parser.add_argument("--jobs", metavar="N", type=int, help="number of parallel requests, Default=4", default=4)
+    parser.add_argument("--cache-dir", metavar="DIR", help="input digest cache directory")
+    parser.add_argument("--no-cache", help="do not use the input digest cache", action="store_true", default=False)
+    args = parser.parse_args(argv)
+
+    if args.jobs < 1:
+        parser.error("invalid number of jobs={}".format(args.jobs))
+
+    cache = None if args.no_cache else DigestCache(args.cache_dir)
+
+    srv = BuildServer(args.socket, args.jobs, cache)
+    srv.preload(args.ecc_key, args.lms_key)
+    asyncio.run(srv.run())
+
+    return 0
@@ -0,0 +1,176 @@
+# Copyright (c) 2024 ASPEED Technology Inc.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import argparse
+import hashlib
+import json
+from concurrent.futures import ProcessPoolExecutor
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.asymmetric.utils import encode_dss_signature
+from cryptography.hazmat.primitives.serialization import load_pem_public_key
+from os import path
+from hdr_parse import MappedImage
+from hdr_parse import parse_image
+from key_index import ECC_PUB_PATTERN
+from key_index import LMS_PUB_PATTERN
+from lms_sign import lms_sig_from_hdr
+from pyhsslms import HssPublicKey
+import hdr_v2
+
+# public keys parsed by this worker process, keyed by file path
+_pub_keys = {}
+
+def load_ecc_pub(key_path):
+    if key_path not in _pub_keys:
+        f = open(key_path, "rb")
+        _pub_keys[key_path] = load_pem_public_key(f.read())
+        f.close()
+
+    return _pub_keys[key_path]
+
+def load_lms_pub(key_path):
+    if key_path not in _pub_keys:
+        f = open(key_path, "rb")
+        _pub_keys[key_path] = HssPublicKey.deserialize(f.read())
+        f.close()
+
+    return _pub_keys[key_path]
+
+def verify_ecc(pub, body, sig) -> bool:
+    r_len = hdr_v2.ECC_KEY_LEN // 2
+    r = int.from_bytes(sig[: r_len], "big")
+    s = int.from_bytes(sig[r_len :], "big")
+
+    try:
+        pub.verify(encode_dss_signature(r, s), body, ec.ECDSA(hashes.SHA384()))
+    except InvalidSignature:
+        return False
+
+    return True
+
+def verify_lms(pub, body, sig) -> bool:
+    # the header carries a single level HSS signature, Nspk = 0
+    hss_sig = (0).to_bytes(4, "big") + lms_sig_from_hdr(sig)
+
+    return pub.verify(hashlib.sha384(body).digest(), hss_sig)
+
+def verify_image(img_path, key_dir, ecc_pattern=ECC_PUB_PATTERN, lms_pattern=LMS_PUB_PATTERN,
+                 require_signed=False) -> dict:
+    result = { "image" : img_path, "reasons" : [] }
+    reasons = result["reasons"]
+
+    try:
+        with MappedImage(img_path) as m:
+            info = parse_image(m.view)
+            view = m.view
+
+            result["version"] = info.version
+            # a v1 header is structurally valid but cannot be authenticated
+            if info.version != 2:
+                result["note"] = "version {} header carries no digest or signature".format(info.version)
+                if require_signed:
+                    reasons.append(result["note"])
+            else:
+                # section digests
+                fmc = view[info.fmc_offset : info.fmc_offset + info.fmc_size]
+                if hashlib.sha384(fmc).digest() != info.fmc_dgst:
+                    reasons.append("FMC digest mismatch")
+                fmc.release()
+
+                for pb in info.prebuilts:
+                    data = view[pb.offset : pb.offset + pb.size]
+                    if hashlib.sha384(data).digest() != pb.dgst:
+                        reasons.append("prebuilt type {} digest mismatch".format(pb.type))
+                    data.release()
+
+                body = bytes(view[hdr_v2.HDR_PREAMBLE_SIZE : hdr_v2.HDR_SIZE])
+
+                # signatures over the header body with the recorded key indexes
+                if any(info.ecc_signature):
+                    key_path = path.join(key_dir, ecc_pattern.format(info.ecc_key_index))
+                    result["ecc_key"] = key_path
+                    if not path.isfile(key_path):
+                        reasons.append("no ECDSA384 key for index {}".format(info.ecc_key_index))
+                    elif not verify_ecc(load_ecc_pub(key_path), body, info.ecc_signature):
+                        reasons.append("ECDSA384 signature mismatch with key index {}".format(info.ecc_key_index))
+                elif require_signed:
+                    reasons.append("ECDSA384 signature missing")
+
+                if any(info.lms_signature):
+                    key_path = path.join(key_dir, lms_pattern.format(info.lms_key_index))
+                    result["lms_key"] = key_path
+                    if not path.isfile(key_path):
+                        reasons.append("no LMS key for index {}".format(info.lms_key_index))
+                    elif not verify_lms(load_lms_pub(key_path), body, info.lms_signature):
+                        reasons.append("LMS signature mismatch with key index {}".format(info.lms_key_index))
+                elif require_signed:
+                    reasons.append("LMS signature missing")
+    except (OSError, RuntimeError, ValueError) as e:
+        reasons.append(str(e))
+
+    result["status"] = "pass" if len(reasons) == 0 else "fail"
+
+    return result
+
+def _verify_worker(args):
+    return verify_image(*args)
+
+def verify_images(images, key_dir, jobs=1, ecc_pattern=ECC_PUB_PATTERN,
+                  lms_pattern=LMS_PUB_PATTERN, require_signed=False) -> list:
+    work = [(img, key_dir, ecc_pattern, lms_pattern, require_signed) for img in images]
+
+    if jobs <= 1 or len(work) <= 1:
+        return [_verify_worker(w) for w in work]
+
+    # each worker keeps its own parsed public keys across images
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        return list(pool.map(_verify_worker, work, chunksize=max(1, len(work) // (jobs * 4))))
+
+def cmd_verify(argv) -> int:
+    parser = argparse.ArgumentParser(prog="fmc-imgtool verify", description="verify digests and signatures of FMC images")
+    parser.add_argument("images", metavar="IMG", nargs="+", help="FMC binary with header")
+    parser.add_argument("--key-dir", metavar="DIR", help="public keys directory, Default=keys/", default="keys/")
+    parser.add_argument("--ecc-pattern", metavar="FMT", help="ECDSA384 public key file name, Default={}".format(ECC_PUB_PATTERN), default=ECC_PUB_PATTERN)
+    parser.add_argument("--lms-pattern", metavar="FMT", help="LMS public key file name, Default={}".format(LMS_PUB_PATTERN), default=LMS_PUB_PATTERN)
+    parser.add_argument("--require-signed", help="fail images without ECDSA384 and LMS signatures", action="store_true", default=False)
+    parser.add_argument("--jobs", metavar="N", type=int, help="number of worker processes, Default=1", default=1)
+    parser.add_argument("--report", metavar="FILE", help="write the verification report as JSON")
+    args = parser.parse_args(argv)
+
+    results = verify_images(args.images, args.key_dir, args.jobs,
+                            args.ecc_pattern, args.lms_pattern, args.require_signed)
+
+    for r in results:
+        if r["status"] == "pass":
+            print("PASS {}".format(r["image"]))
+        else:
+            print("FAIL {}: {}".format(r["image"], "; ".join(r["reasons"])))
+
+    failed = sum(1 for r in results if r["status"] != "pass")
+    print("{} passed, {} failed".format(len(results) - failed, failed))
+
+    if args.report is not None:
+        f = open(args.report, "w")
+        json.dump({ "images" : results, "passed" : len(results) - failed, "failed" : failed }, f, indent=2)
+        f.close()
+
+    return 1 if failed else 0
@@ -0,0 +1,219 @@
+# Copyright (c) 2024 ASPEED Technology Inc.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import select
+import sys
+import time
+from os import path
+from main import gen_fmc_info
+from main import gen_one_prebuilt_info
+from main import gen_fmc_hdr_v1
+from main import gen_fmc_hdr_v2
+from main import load_ecc_key
+from main import load_lms_key
+from main import write_image
+from prebuilt import PREBUILT_BIN
+
+WATCH_POLL_INTERVAL = 0.2       # seconds between two scans without inotify
+
+# inotify(7) events which may change a watched file or replace it
+IN_MODIFY = 0x002
+IN_ATTRIB = 0x004
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+def _stat_key(file_path):
+    # compilers and editors often replace files, compare the inode as well
+    try:
+        st = os.stat(file_path)
+    except OSError:
+        return None
+
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns)
+
+class InotifyWatch:
+    # wakes up on any change in the directories of the watched files, the
+    # caller then compares the files themselves
+    def __init__(self, dirs):
+        import ctypes
+        import ctypes.util
+
+        self.__libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.__libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1")
+
+        for d in dirs:
+            if self.__libc.inotify_add_watch(self.fd, os.fsencode(d), IN_WATCH_MASK) < 0:
+                err = ctypes.get_errno()
+                os.close(self.fd)
+                raise OSError(err, "inotify_add_watch {}".format(d))
+
+    def wait(self, timeout=None) -> bool:
+        r, _, _ = select.select([self.fd], [], [], timeout)
+        if len(r) == 0:
+            return False
+
+        # the events are not decoded, drain them all
+        try:
+            while os.read(self.fd, 0x10000):
+                pass
+        except BlockingIOError:
+            pass
+
+        return True
+
+    def close(self):
+        os.close(self.fd)
+
+class PollWatch:
+    def __init__(self, files):
+        self.__files = files
+        self.__stats = [_stat_key(f) for f in files]
+
+    def wait(self, timeout=None) -> bool:
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        while True:
+            delay = WATCH_POLL_INTERVAL
+            if deadline is not None:
+                delay = min(delay, deadline - time.monotonic())
+            if delay > 0:
+                time.sleep(delay)
+
+            stats = [_stat_key(f) for f in self.__files]
+            if stats != self.__stats:
+                self.__stats = stats
+                return True
+
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+
+    def close(self):
+        pass
+
+# state kept across rebuilds: the digest of every section and the parsed
+# keys, each one refreshed only when the stat of its file changes
+class WatchBuild:
+    def __init__(self, args, cache=None):
+        self.args = args
+        self.cache = cache
+        self.prebuilts = { args.prebuilt_dir + n : n for n in PREBUILT_BIN }
+
+        # an LMS signature rewrites the .prv, the key identity is its .pub
+        self.keys = {}
+        if args.version == 2 and args.ecc_key is not None:
+            self.keys[args.ecc_key] = load_ecc_key
+        if args.version == 2 and args.lms_key is not None:
+            self.keys[path.splitext(args.lms_key)[0] + ".pub"] = lambda _: load_lms_key(args.lms_key)
+
+        self.files = [args.input] + list(self.prebuilts) + list(self.keys)
+        self.stats = {}
+        self.infos = {}
+        self.loaded = {}
+
+    def dirs(self):
+        return sorted(set(path.dirname(path.abspath(f)) for f in self.files))
+
+    def refresh(self) -> list:
+        # rereads the files which changed since the last build and returns them
+        changed = []
+
+        for f in self.files:
+            st = _stat_key(f)
+            if st is not None and st == self.stats.get(f):
+                continue
+
+            if f == self.args.input:
+                self.infos[f] = gen_fmc_info(f, self.args.svn, self.cache)
+            elif f in self.keys:
+                self.loaded[f] = self.keys[f](f)
+            else:
+                name = self.prebuilts[f]
+                self.infos[f] = gen_one_prebuilt_info(self.args.prebuilt_dir, name, PREBUILT_BIN[name], self.cache)
+
+            # taken before reading, a write during the read shows up next time
+            self.stats[f] = st
+            changed.append(f)
+
+        return changed
+
+    def build(self):
+        args = self.args
+        fmc_info = self.infos[args.input]
+        pbs_info = [self.infos[f] for f in self.prebuilts]
+
+        if args.version == 1:
+            hdr = gen_fmc_hdr_v1(fmc_info, pbs_info)
+        else:
+            lms_key = None
+            if args.lms_key is not None:
+                lms_key = self.loaded[path.splitext(args.lms_key)[0] + ".pub"]
+            hdr = gen_fmc_hdr_v2(fmc_info, pbs_info,
+                                 args.ecc_key_index, self.loaded.get(args.ecc_key),
+                                 args.lms_key_index, lms_key, args.deterministic_ecdsa)
+
+        write_image(args.output, hdr, fmc_info, pbs_info, args.verbose)
+
+    def update(self) -> bool:
+        start = time.perf_counter()
+
+        try:
+            # a failed build is retried with the next change of any input
+            changed = self.refresh()
+            if len(changed) == 0:
+                return False
+            self.build()
+        except (OSError, RuntimeError) as e:
+            print("FAILED {}: {}".format(self.args.output, e), file=sys.stderr)
+            return False
+
+        what = ", ".join(path.basename(f) for f in changed)
+        if len(changed) == len(self.files):
+            what = "all inputs"
+        print("OK     {} ({:.1f}ms, {})".format(self.args.output, (time.perf_counter() - start) * 1000, what))
+        sys.stdout.flush()
+
+        return True
+
+def watch_build(args, cache=None, delay=0.02):
+    wb = WatchBuild(args, cache)
+    wb.update()
+
+    try:
+        w = InotifyWatch(wb.dirs())
+    except (OSError, AttributeError):
+        w = PollWatch(wb.files)
+
+    try:
+        while True:
+            w.wait()
+            # let the writer finish, rebuild once the inputs are quiet
+            while w.wait(delay):
+                pass
+            wb.update()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        w.close()